@@ -29,6 +29,17 @@ cp -f "${PWD}"/src/advfn.py "${PWD}"/SMF/
 cp -f "${PWD}"/src/yahoo_hist.py "${PWD}"/SMF/
 cp -f "${PWD}"/src/html_hist_quote.py "${PWD}"/SMF/
 cp -f "${PWD}"/src/app_logger.py "${PWD}"/SMF/
+cp -f "${PWD}"/src/smf_config.py "${PWD}"/SMF/
+cp -f "${PWD}"/src/smf_cache.py "${PWD}"/SMF/
+cp -f "${PWD}"/src/single_flight.py "${PWD}"/SMF/
+cp -f "${PWD}"/src/async_fetch.py "${PWD}"/SMF/
+cp -f "${PWD}"/src/exchange_index.py "${PWD}"/SMF/
+cp -f "${PWD}"/src/http_client.py "${PWD}"/SMF/
+cp -f "${PWD}"/src/circuit_breaker.py "${PWD}"/SMF/
+cp -f "${PWD}"/src/deadline.py "${PWD}"/SMF/
+cp -f "${PWD}"/src/hist_router.py "${PWD}"/SMF/
+cp -f "${PWD}"/src/wsj_hist.py "${PWD}"/SMF/
+cp -f "${PWD}"/src/trading_calendar.py "${PWD}"/SMF/
 cp -f "${PWD}"/src/description-en-US.txt "${PWD}"/SMF/
 cp -f "${PWD}"/certifi/cacert.pem "${PWD}"/SMF/
 python "${PWD}"/src/generate_metainfo.py
@@ -11,162 +11,216 @@
 #
 # NOTE: Due to the way the site is structured, data is gathered for
 #      1yr with the 1st call and in 5yr increments thereafter, for
-#      a maximum of 21yrs total. The current implementation requests
-#      pages in order from newest to oldest. Efficiency may be
-#      increased by requesting only pages with needed data.
-try:
-    from urllib.request import Request, urlopen
-    from urllib.error import URLError
-    from html.parser import HTMLParser
-
-    major_version = 3
-except ImportError:
-    from urllib2 import Request, urlopen, URLError
-    from HTMLParser import HTMLParser
-
-    major_version = 2
+#      a maximum of 21yrs total. Only the pages holding the requested
+#      year are downloaded, together with the newest year page which
+#      anchors the year columns. The pages are downloaded concurrently
+#      and placed in the table by year, so arrival order does not matter.
+from urllib.error import URLError
+from html.parser import HTMLParser
+from codecs import getincrementaldecoder
+from concurrent.futures import ThreadPoolExecutor
 import smf
+import circuit_breaker
+import http_client
+import single_flight
+import smf_cache
+
+
+# Pages most recent year first. Page 21 holds one year, the others five.
+START_LIST = [21, 16, 11, 6, 1]
+# Year columns in a complete data set.
+YEAR_COUNT = 21
+# Rows in a page table, the year end dates included. Datacodes go up to 5291.
+ROW_COUNT = 252
+NO_DATA = 'No Data'
+# Bytes read from the response at a time.
+CHUNK_SIZE = 16 * 1024
+
+
+class ADVFNState:
+    """Pages collected so far for one ticker"""
+
+    def __init__(self):
+        # start_date -> page rows, most recent year first.
+        self.pages = {}
+        # Row-major table of YEAR_COUNT columns. None marks a cell whose
+        # page has not been downloaded yet.
+        self.total_advfn_data = []
+        self.complete = False
 
 
 def fetch_advfn(self, ticker, datacode):
     """Get ADVFN data and return desired element to user """
     if datacode < 1 or datacode > 5291:
         return 'Invalid Datacode'
-    if self.advfn_flag[3] == ticker and self.advfn_flag[5] == True:
-        row, col = divmod(datacode - 1, len(self.total_advfn_data[0]))
-        return self.total_advfn_data[row][col]
-
-    if self.advfn_flag[3] != ticker or (datacode % 21) not in \
-            range(self.advfn_flag[2]):
-        query_advfn(self, ticker)  # Enable for normal use.
-        #        test_query_advfn(self, ticker)#Enable for testing purposes only.
-        if self.advfn_flag[4] != None:
-            return self.advfn_flag[4]
-        clean_advfn(self)
-        organize_advfn(self)
-    row, col = divmod(datacode - 1, len(self.total_advfn_data[0]))
-    return self.total_advfn_data[row][col]
-
-
-def test_query_advfn(self, ticker):
+    row, col = divmod(datacode - 1, YEAR_COUNT)
+    state = self.advfn_store.get(ticker)
+    if state is None:
+        state = ADVFNState()
+        # Use the complete data set saved by an earlier session if it is still fresh.
+        saved = smf_cache.load_snapshot('advfn', ticker, 'annual_reports')
+        if saved is not None:
+            state.total_advfn_data = saved
+            state.complete = True
+            self.advfn_store.put(ticker, state)
+    if not have_column(state, col):
+        # The newest year page tells which year each column holds.
+        needed = [start for start in (START_LIST[0], page_for_column(col))
+                  if start not in state.pages]
+        error = query_advfn(state, self, ticker, needed)
+        if state.pages:
+            place_advfn(state)
+            # Save the data set once every page has been collected.
+            if state.complete:
+                smf_cache.save_snapshot('advfn', ticker, 'annual_reports',
+                                        state.total_advfn_data)
+            # Store again so the store accounts for the pages just added.
+            self.advfn_store.put(ticker, state)
+        if not have_column(state, col):
+            return error if error is not None else NO_DATA
+    if row >= len(state.total_advfn_data):
+        return NO_DATA
+    return state.total_advfn_data[row][col]
+
+
+def have_column(self, col):
+    """True if the year column has been downloaded"""
+    return self.complete or (len(self.total_advfn_data) > 0 and
+                             col < len(self.total_advfn_data[0]) and
+                             self.total_advfn_data[0][col] is not None)
+
+
+def page_for_column(col):
+    """Return the start_date of the page holding year column col"""
+    if col == 0:
+        return START_LIST[0]
+    return START_LIST[1 + (col - 1) // 5]
+
+
+def page_columns(start_date):
+    """Return the year columns a page covers"""
+    idx = START_LIST.index(start_date)
+    if idx == 0:
+        return range(0, 1)
+    return range(1 + (idx - 1) * 5, 1 + idx * 5)
+
+
+def test_download_advfn(exchange, ticker, start_date):
     """Open local html files for testing purposes"""
     import os
     working_dir = os.path.dirname(__file__)
     rel_path = "advfn/dd/"
     file_path = os.path.join(working_dir, rel_path)
-    file = (file_path + str(self.advfn_start_list[self.advfn_flag[0]]) + '.html')
-    try:
-        with open(file, 'r') as raw_advfn:
-            # Parse raw html for the data we want and set flags on completion.
-            parse_advfn = ADVFNParser()
-            parse_advfn.feed(raw_advfn.read())
-            self.advfn_data = parse_advfn.result()
-            self.advfn_flag[0] += 1
-            self.advfn_flag[3] = ticker
-    except IOError as e:
-        if hasattr(e, 'reason'):
-            self.advfn_flag[4] = e.reason
-        elif hasattr(e, 'code'):
-            self.advfn_flag[4] = e.code
-        return
+    file = (file_path + str(start_date) + '.html')
+    with open(file, 'rb') as raw_advfn:
+        return extract_advfn(raw_advfn, 'utf-8')
 
 
-def query_advfn(self, ticker):
-    """Query ADVFN for the data we want"""
-    exchange = advfn_exchange(self, ticker)
+def query_advfn(self, smf_impl, ticker, start_dates):
+    """Query ADVFN for the pages we want. Returns None or an error."""
+    if not start_dates:
+        return None
+    exchange = advfn_exchange(smf_impl, ticker)
     if exchange not in ['NYSE', 'NASDAQ', 'AMEX']:
         return exchange
-    url = 'http://www.advfn.com/stock-market/%s/%s/financials?btn=start_date&' \
-          'start_date=%s&mode=annual_reports' % (exchange, ticker,
-                                                 self.advfn_start_list
-                                                 [self.advfn_flag[0]])
-    req = Request(url)
+    # Download the pages at the same time.
+    with ThreadPoolExecutor(max_workers=len(start_dates)) as executor:
+        results = list(executor.map(lambda start_date: query_page(exchange, ticker, start_date),
+                                    start_dates))
+    error = None
+    for start_date, (page, page_error) in zip(start_dates, results):
+        if page_error is not None:
+            error = page_error
+        else:
+            self.pages[start_date] = page
+    return error
+
+
+def query_page(exchange, ticker, start_date):
+    """Download one page. Returns (page rows, None) or (None, error)."""
+    # Concurrent requests for the same page share one download.
     try:
-        response = urlopen(req)
-    except URLError as e:
+        data = single_flight.provider_flight.do(('advfn', ticker, start_date),
+                                                circuit_breaker.call, 'advfn',
+                                                download_advfn, exchange, ticker,
+                                                start_date)
+        #        data = test_download_advfn(exchange, ticker, start_date)#Enable for testing purposes only.
+    except (URLError, IOError) as e:
         if hasattr(e, 'reason'):
-            self.advfn_flag[4] = e.reason
+            return None, e.reason
         elif hasattr(e, 'code'):
-            self.advfn_flag[4] = e.code
-        return
-        # Parse raw html for the data we want and set flags on completion.
-    parse_advfn = ADVFNParser()
-    if major_version == 3:
-        r_html = response.read().decode(response.headers.get_content_charset())
-    else:
-        r_html = response.read().decode(response.headers.getparam('charset'))
-    parse_advfn.feed(r_html)
-    self.advfn_data = parse_advfn.result()
-    self.advfn_flag[0] += 1
-    self.advfn_flag[3] = ticker
-    return
-
-
-def clean_advfn(self):
-    """Format raw html to useable data"""
-    page = self.advfn_data
-    self.advfn_flag[1] = 0
-    # Strip month from year end date.
-    for ye_idx in range(1, 6):
-        if len(page[ye_idx]) == 7:
-            # Track year count for this dataset.
-            self.advfn_flag[1] += 1
-            ye_date = page[ye_idx]
-            page[ye_idx] = ye_date[:4]
-    # Strip commas (try/except for Python 2.x compatibility).
-    for idx in range(len(page)):
-        try:
-            page[idx] = (str(page[idx])).translate({ord(i): None for i in ','})
-        except:
-            page[idx] = (str(page[idx])).translate(None, ',')
-    # Strip non-numeric values (ie. data descriptors).
-    for element in page[:]:
-        if not is_number(element):
-            page.remove(element)
-    # Increment total year count for data we have already.
-    self.advfn_flag[2] += self.advfn_flag[1]
-    return
-
-
-def organize_advfn(self):
-    """Organize data into a 2d list"""
-    organized_data = [self.advfn_data[idx:idx + self.advfn_flag[1]] for idx in
-                      range(0, len(self.advfn_data), self.advfn_flag[1])]
-    # Move newest years from last to first in array.
-    [i.reverse() for i in organized_data]
-    # Append 1st year data to our total data.
-    if self.advfn_flag[0] == 1:
-        self.old_advfn_data = organized_data
-        self.total_advfn_data = organized_data
-        return
-    # Check for > 5yr chunk and pad missing elements.
-    if (self.advfn_flag[1] > 1 and self.advfn_flag[1] < 5):
-        while len(self.total_advfn_data[0]) < 21:
-            [n.append('No Data') for n in self.total_advfn_data]
-        self.advfn_flag[5] = True
-        return
-    # Discard data we already have and pad missing elements.
-    match = [i in self.total_advfn_data[0] for i in organized_data[0]]
-    if True in match:
-        while len(self.total_advfn_data[0]) < 21:
-            [n.append('No Data') for n in self.total_advfn_data]
-        self.advfn_flag[5] = True
+            return None, e.code
+        return None, str(e)
+    # A page without the financials table is not kept, so it is asked for again.
+    if not data:
+        return None, NO_DATA
+    return data, None
+
+
+def place_advfn(self):
+    """Place the downloaded pages in the table by year"""
+    newest = self.pages.get(START_LIST[0])
+    if not newest or not newest[0]:
         return
-    # Collate new data with total data.
-    else:
-        self.total_advfn_data = [x + y for x, y in zip(self.old_advfn_data,
-                                                       organized_data)]
-        self.old_advfn_data = self.total_advfn_data
-    return
+    newest_year = int(float(newest[0][0]))
+    row_count = max(len(page) for page in self.pages.values())
+    table = [[None] * YEAR_COUNT for i in range(row_count)]
+    for start_date in START_LIST:
+        page = self.pages.get(start_date)
+        if page is None:
+            continue
+        # Years missing from the page have no data. For start dates beyond
+        # the company's history ADVFN repeats years of a newer page.
+        for col in page_columns(start_date):
+            for table_row in table:
+                table_row[col] = NO_DATA
+        for idx, year in enumerate(page[0]):
+            col = newest_year - int(float(year))
+            if col not in page_columns(start_date):
+                continue
+            for table_row, page_row in zip(table, page):
+                table_row[col] = page_row[idx]
+    self.total_advfn_data = table
+    self.complete = history_ended(self)
+    if self.complete:
+        # Pad the years older than the company's history.
+        for table_row in table:
+            for col in range(YEAR_COUNT):
+                if table_row[col] is None:
+                    table_row[col] = NO_DATA
 
 
-def is_number(element):
-    """Test for number vs. non-number strings"""
-    try:
-        float(element)
-        return True
-    except ValueError:
-        return False
+def history_ended(self):
+    """True once every page up to the oldest year with data is known"""
+    for start_date in START_LIST:
+        if start_date not in self.pages:
+            return False
+        # A page without all of its years is the last one with data.
+        if NO_DATA in [self.total_advfn_data[0][col] for col in page_columns(start_date)]:
+            return True
+    return True
+
+
+def download_advfn(exchange, ticker, start_date):
+    """Download one ADVFN financials page and return its table"""
+    url = 'http://www.advfn.com/stock-market/%s/%s/financials?btn=start_date&' \
+          'start_date=%s&mode=annual_reports' % (exchange, ticker, start_date)
+    # Closing the response after the financials table discards the rest of
+    # the page, so the page is not revalidated: that would read all of it.
+    with http_client.get(url, provider='advfn') as response:
+        return extract_advfn(response, response.headers.get_content_charset())
+
+
+def extract_advfn(response, charset):
+    """Feed the page to the extractor in chunks until the financials table ends"""
+    extractor = ADVFNExtractor()
+    decoder = getincrementaldecoder(charset or 'utf-8')(errors='replace')
+    while not extractor.done:
+        chunk = response.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        extractor.feed(decoder.decode(chunk))
+    return extractor.result()
 
 
 def advfn_exchange(self, ticker):
@@ -181,29 +235,95 @@ def advfn_exchange(self, ticker):
     return exchange
 
 
-class ADVFNParser(HTMLParser):
-    """Class to parse ADVFN html. 'handle' methods are built-in"""
+class ADVFNExtractor(HTMLParser):
+    """
+    Streaming parser for an ADVFN financials page. 'handle' methods are built-in.
+    Cells are converted as they arrive: the year end dates become the
+    first row and the numeric cells are written into the following rows
+    of a table allocated once the year count is known, most recent year
+    first. Descriptors and other non-numeric cells are skipped.
+    """
 
     def __init__(self):
         HTMLParser.__init__(self)
-        self.data_list = []
-        self.lasttag = None
-        self.inLink = False
+        self.table = []
+        # Numeric cells written so far.
+        self.values = 0
+        self.years = []
+        self.year_count = 0
+        # Cells seen so far, the year end dates are cells 1 to 5.
+        self.cell_count = 0
+        self.text = []
+        self.in_cell = False
+        self.in_data = False
+        self.table_depth = 0
+        self.data_depth = None
+        self.done = False
 
     def handle_starttag(self, tag, attrs):
-        if tag == "td":
-            for name, value in attrs:
-                if name == "class" and (value == "s" or value == "sb"):
-                    self.inLink = True
-                    self.lasttag = tag
+        self.end_cell()
+        if tag == "table":
+            self.table_depth += 1
+        elif tag == "td":
+            if not self.in_data:
+                for name, value in attrs:
+                    if name == "class" and (value == "s" or value == "sb"):
+                        self.in_data = True
+                        # Stop at the end of the financials table itself.
+                        self.data_depth = self.table_depth
+            self.in_cell = self.in_data
 
     def handle_endtag(self, tag):
-        if tag == "td":
-            self.inlink = False
+        self.end_cell()
+        if tag == "table":
+            if self.data_depth is not None and self.table_depth == self.data_depth:
+                self.done = True
+            self.table_depth -= 1
 
     def handle_data(self, data):
-        if self.lasttag == 'td' and self.inLink and data.strip():
-            self.data_list.append(data)
+        # A cell's text can arrive in more than one piece.
+        if self.in_cell and not self.done:
+            self.text.append(data)
+
+    def end_cell(self):
+        """Convert the text collected since the last td start tag"""
+        self.in_cell = False
+        if not self.text:
+            return
+        cell = ''.join(self.text).strip()
+        self.text = []
+        if not cell:
+            return
+        self.cell_count += 1
+        # Year end dates look like 2015/12.
+        if 2 <= self.cell_count <= 6 and len(cell) == 7:
+            try:
+                self.years.append(float(cell[:4]))
+                return
+            except ValueError:
+                pass
+        if self.years and not self.table:
+            # The page lists the oldest year first.
+            self.year_count = len(self.years)
+            self.table = [[NO_DATA] * self.year_count for i in range(ROW_COUNT)]
+            self.table[0] = self.years[::-1]
+        try:
+            value = float(cell.replace(',', ''))
+        except ValueError:
+            return
+        if self.year_count == 0:
+            return
+        row, idx = divmod(self.values, self.year_count)
+        if row + 1 >= ROW_COUNT:
+            return
+        self.table[row + 1][self.year_count - 1 - idx] = value
+        self.values += 1
 
     def result(self):
-        return self.data_list
\ No newline at end of file
+        """Return the rows written so far"""
+        self.end_cell()
+        if not self.table:
+            return []
+        # Rows started so far, with the year end dates.
+        rows = 1 + (self.values + self.year_count - 1) // self.year_count
+        return self.table[:rows]
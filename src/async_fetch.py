@@ -0,0 +1,219 @@
+#  async_fetch.py - Non-blocking provider fetches for the SMF Extension.
+#
+#  license: GNU LGPL
+#
+#  This library is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  NOTE
+#  Normally every add-in function blocks the Calc thread until its data
+#  arrives. When async_mode is enabled in smf.conf, a cache miss instead
+#  returns an AsyncResult, which Calc treats as a volatile result
+#  (com.sun.star.sheet.XVolatileResult). The cell shows a placeholder
+#  while the fetch runs on a bounded worker pool. When the data arrives,
+#  the registered result listeners are sent a ResultEvent with the value
+#  and Calc updates the cell. Cache hits are still answered synchronously.
+#
+#  Calc calls the add-in function again after the update. Values that did
+#  not go into a cache (error messages, for example) would start another
+#  fetch and the cell would never settle. So each finished value is kept
+#  for COMPLETED_TTL seconds and handed to the next call with the same key.
+#
+#  The UNO parts are optional. Without UNO (e.g. when testing headless)
+#  AsyncResult is a plain object and listeners only need a modified(event)
+#  method.
+#
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from app_logger import AppLogger
+import deadline
+from smf_config import SMFConfiguration
+
+# Logger init
+app_logger = AppLogger("smf-extension")
+logger = app_logger.getAppLogger()
+
+try:
+    import uno
+    import unohelper
+    from com.sun.star.sheet import XVolatileResult
+    uno_available = True
+except ImportError:
+    uno_available = False
+
+# Seconds a finished value waits for Calc to call the function again
+COMPLETED_TTL = 60.0
+# Most finished values kept at a time
+COMPLETED_MAX = 10000
+
+
+if uno_available:
+    class AsyncResultBase(unohelper.Base, XVolatileResult):
+        pass
+
+    def make_result_event(source, value):
+        event = uno.createUnoStruct("com.sun.star.sheet.ResultEvent")
+        event.Source = source
+        event.Value = value
+        return event
+else:
+    class AsyncResultBase(object):
+        pass
+
+    class ResultEvent:
+        """Headless stand-in for com.sun.star.sheet.ResultEvent"""
+        def __init__(self, source, value):
+            self.Source = source
+            self.Value = value
+
+    def make_result_event(source, value):
+        return ResultEvent(source, value)
+
+
+class AsyncResult(AsyncResultBase):
+    """
+    Volatile result for a cell whose data is being fetched in the background.
+    Implements com.sun.star.sheet.XVolatileResult.
+    """
+    def __init__(self, key, placeholder):
+        self.key = key
+        self.value = placeholder
+        self.complete = False
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def addResultListener(self, listener):
+        """
+        Called by Calc to register the cell. The listener immediately gets
+        the current value, which is the placeholder until the fetch completes.
+        """
+        with self.lock:
+            self.listeners.append(listener)
+            value = self.value
+        listener.modified(make_result_event(self, value))
+
+    def removeResultListener(self, listener):
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def set_result(self, value):
+        """
+        Record the fetched value and notify every registered listener
+        :param value: Value for the cell
+        :return: None
+        """
+        with self.lock:
+            self.value = value
+            self.complete = True
+            listeners = list(self.listeners)
+        for listener in listeners:
+            try:
+                listener.modified(make_result_event(self, value))
+            except Exception as ex:
+                logger.error("Result listener failed for %s: %s", self.key, str(ex))
+
+
+class AsyncFetcher:
+    """
+    Runs fetches on a bounded worker pool. Calls with the same key
+    while a fetch is pending get the same AsyncResult. The first call
+    after the fetch finished gets the value itself.
+    """
+    def __init__(self, max_workers, placeholder):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.placeholder = placeholder
+        self.lock = threading.Lock()
+        self.pending = {}
+        # key -> (expiration time, value) of finished fetches
+        self.completed = OrderedDict()
+
+    def submit(self, key, fetch, after=None):
+        """
+        Start a background fetch unless one is already pending for key
+        :param key: Hashable key identifying the cell request, e.g. (function name, args...)
+        :param fetch: Function returning the cell value
+        :param after: Optional Future. fetch is only queued once it is done,
+        so no worker is tied up while the download runs elsewhere.
+        :return: AsyncResult for the request, or the value if a fetch for key just finished
+        """
+        with self.lock:
+            result = self.pending.get(key)
+            if result is not None:
+                return result
+            finished = self.completed.pop(key, None)
+            if finished is not None and finished[0] > time.time():
+                return finished[1]
+            result = AsyncResult(key, self.placeholder)
+            self.pending[key] = result
+        if after is None:
+            self.executor.submit(self.__run, result, fetch)
+        else:
+            after.add_done_callback(lambda f: self.executor.submit(self.__run, result, fetch))
+        return result
+
+    def __run(self, result, fetch):
+        try:
+            # Background fetches do not hold up Calc
+            with deadline.exempt():
+                value = fetch()
+        except Exception as ex:
+            value = str(ex)
+        with self.lock:
+            self.pending.pop(result.key, None)
+            self.completed.pop(result.key, None)
+            self.completed[result.key] = (time.time() + COMPLETED_TTL, value)
+            while len(self.completed) > COMPLETED_MAX:
+                self.completed.popitem(last=False)
+        result.set_result(value)
+
+    def pending_count(self):
+        with self.lock:
+            return len(self.pending)
+
+
+fetcher = AsyncFetcher(int(SMFConfiguration.get("async_workers")),
+                       SMFConfiguration.get("async_placeholder"))
+
+
+def is_enabled():
+    """
+    :return: True if async mode is switched on in smf.conf
+    """
+    return bool(SMFConfiguration.get("async_mode"))
+
+
+def dispatch(key, cached, fetch):
+    """
+    Return a cell value, fetching in the background on a cache miss when async mode is on.
+    :param key: Hashable key identifying the cell request
+    :param cached: Function returning the cached value, or None on a cache miss
+    :param fetch: Function returning the value, fetching it if necessary
+    :return: The value, or an AsyncResult if it is being fetched in the background
+    """
+    if not is_enabled():
+        return fetch()
+    value = cached()
+    if value is not None:
+        return value
+    return fetcher.submit(key, fetch)
+
+
+"""
+Test code
+"""
+if __name__ == "__main__":
+    import time
+
+    class StubListener:
+        def modified(self, event):
+            print("modified:", event.Value)
+
+    r = fetcher.submit(("test", "XOM"), lambda: (time.sleep(1), 85.5)[1])
+    r.addResultListener(StubListener())
+    time.sleep(2)
@@ -0,0 +1,212 @@
+#  circuit_breaker.py - Per provider circuit breakers for the SMF Extension.
+#
+#  license: GNU LGPL
+#
+#  This library is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  NOTE
+#  When a provider is down every cell would otherwise make its own failing
+#  request, and a sheet can take minutes to show the errors. Each provider
+#  has a circuit breaker:
+#
+#  * closed - requests go through. After breaker_failure_threshold
+#    consecutive failures the breaker opens.
+#  * open - requests fail immediately with CircuitOpenError until the
+#    backoff time has passed. The backoff starts at breaker_reset_timeout
+#    seconds and doubles each time the breaker opens again, up to
+#    breaker_max_timeout. It is jittered so that several LO processes do
+#    not probe at the same moment.
+#  * half open - one probe request is let through. Success closes the
+#    breaker, failure opens it again with a longer backoff.
+#
+#  Network errors, HTTP 5xx and HTTP 429 count as failures. Other HTTP
+#  errors (e.g. 404 for an unknown symbol) mean the provider is up.
+#  CircuitOpenError is a URLError, so existing error handling applies.
+#  A request skipped because the recalc budget is spent (see deadline.py)
+#  says nothing about the provider and is not counted either way.
+#
+
+import random
+import threading
+import time
+from urllib.error import URLError, HTTPError
+from app_logger import AppLogger
+from deadline import DeadlineExceededError
+from smf_config import SMFConfiguration
+
+# Logger init
+app_logger = AppLogger("smf-extension")
+logger = app_logger.getAppLogger()
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half open"
+
+PROVIDERS = ["yahoo", "morningstar", "advfn", "nasdaq", "google", "intrinio", "wsj"]
+
+
+class CircuitOpenError(URLError):
+    """
+    Raised instead of making a request while a provider's breaker is open
+    """
+    def __init__(self, provider, retry_in):
+        URLError.__init__(self, "{0} is unavailable, retrying in {1:.0f}s".format(provider, retry_in))
+        self.provider = provider
+        self.retry_in = retry_in
+
+
+def is_failure(ex):
+    """
+    :param ex: Exception raised by a provider request
+    :return: True if the exception means the provider is not working
+    """
+    if isinstance(ex, HTTPError):
+        return ex.code >= 500 or ex.code == 429
+    return isinstance(ex, (URLError, IOError))
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for one provider
+    """
+    def __init__(self, provider, failure_threshold, reset_timeout, max_timeout):
+        self.provider = provider
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_timeout = max_timeout
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        # Times opened since the last success, drives the backoff
+        self.trips = 0
+        self.retry_at = 0.0
+        self.probing = False
+        self.rejected = 0
+        self.opened = 0
+
+    def allow(self):
+        """
+        Check whether a request may be made
+        :return: None
+        :raises CircuitOpenError: if the breaker is open
+        """
+        with self.lock:
+            if self.state == CLOSED:
+                return
+            now = time.time()
+            if self.state == OPEN and now >= self.retry_at:
+                self.state = HALF_OPEN
+                self.probing = False
+            if self.state == HALF_OPEN and not self.probing:
+                # This request is the probe
+                self.probing = True
+                return
+            self.rejected += 1
+            raise CircuitOpenError(self.provider, max(self.retry_at - now, 0))
+
+    def can_try(self):
+        """
+        Check without side effects whether allow() would let a request through now
+        :return: True if the breaker is closed, its backoff has passed or no probe is running
+        """
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                return time.time() >= self.retry_at
+            return not self.probing
+
+    def record_success(self):
+        with self.lock:
+            if self.state != CLOSED:
+                logger.info("%s circuit closed", self.provider)
+            self.state = CLOSED
+            self.failures = 0
+            self.trips = 0
+            self.probing = False
+
+    def record_skipped(self):
+        with self.lock:
+            # Let the next request be the probe
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.__open()
+
+    def __open(self):
+        # The caller holds the lock
+        self.trips += 1
+        self.opened += 1
+        backoff = min(self.reset_timeout * (2 ** (self.trips - 1)), self.max_timeout)
+        backoff *= random.uniform(0.8, 1.2)
+        self.state = OPEN
+        self.probing = False
+        self.failures = 0
+        self.retry_at = time.time() + backoff
+        logger.error("%s circuit open for %.0f seconds", self.provider, backoff)
+
+    def call(self, fn, *args):
+        """
+        Call fn(*args) through the breaker
+        :return: The result of fn
+        :raises CircuitOpenError: if the breaker is open. Exceptions from fn are re-raised.
+        """
+        self.allow()
+        try:
+            result = fn(*args)
+        except DeadlineExceededError:
+            self.record_skipped()
+            raise
+        except Exception as ex:
+            if is_failure(ex):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        self.record_success()
+        return result
+
+    def statistics(self):
+        """
+        :return: Dict of breaker state and counters
+        """
+        with self.lock:
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "trips": self.trips,
+                "opened": self.opened,
+                "rejected": self.rejected,
+                "retry_in": max(self.retry_at - time.time(), 0) if self.state != CLOSED else 0,
+            }
+
+
+breakers = {provider: CircuitBreaker(provider,
+                                     int(SMFConfiguration.get("breaker_failure_threshold")),
+                                     float(SMFConfiguration.get("breaker_reset_timeout")),
+                                     float(SMFConfiguration.get("breaker_max_timeout")))
+            for provider in PROVIDERS}
+
+
+def call(provider, fn, *args):
+    """
+    Make a provider request through the provider's circuit breaker
+    :param provider: One of PROVIDERS
+    :param fn: Function that makes the request
+    :param args: Arguments for fn
+    :return: The result of fn
+    """
+    return breakers[provider].call(fn, *args)
+
+
+def get_statistics():
+    """
+    :return: Dict of provider -> breaker statistics
+    """
+    return {provider: breaker.statistics() for provider, breaker in breakers.items()}
@@ -0,0 +1,149 @@
+#  deadline.py - Per recalculation network time budget for the SMF Extension.
+#
+#  license: GNU LGPL
+#
+#  This library is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  NOTE
+#  Calc evaluates SMF cells one after the other on its own thread, so
+#  slow providers add up and can freeze Calc for a long time. Every add-in
+#  call marks recalculation activity. A call that starts while no other
+#  call is running and more than recalc_idle_gap seconds after the previous
+#  one ended starts a new recalculation, which may spend recalc_budget
+#  seconds on the network. Time spent inside calls never counts as idle.
+#  Requests that would start after the budget is spent fail at once with
+#  DeadlineExceededError (a URLError), and each request's timeouts are
+#  cut down to the time that is left. Cache hits are not affected.
+#  Recalculating again starts a new budget.
+#
+#  Background fetches (async mode) do not hold up Calc and run exempt
+#  from the budget.
+#
+
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from urllib.error import URLError
+from smf_config import SMFConfiguration
+
+
+class DeadlineExceededError(URLError):
+    """
+    Raised instead of making a request once the recalculation budget is spent
+    """
+    def __init__(self, provider):
+        URLError.__init__(self, "Time limit for this recalculation reached, {0} not queried. "
+                                "Recalculate to retry.".format(provider))
+        self.provider = provider
+
+
+# Marks threads that run exempt from the budget
+local = threading.local()
+
+
+class RecalcDeadline:
+    """
+    Process wide budget for the current recalculation
+    """
+    lock = threading.Lock()
+    started = 0.0
+    # End of the most recent add-in call, and the number of calls running
+    last_end = 0.0
+    in_flight = 0
+    recalcs = 0
+    rejected = 0
+
+    @classmethod
+    def begin(cls):
+        """
+        Record the start of an add-in call. Starts a new recalculation after an idle gap.
+        :return: None
+        """
+        now = time.time()
+        with cls.lock:
+            if cls.in_flight == 0 and now - cls.last_end > float(SMFConfiguration.get("recalc_idle_gap")):
+                cls.started = now
+                cls.recalcs += 1
+            cls.in_flight += 1
+
+    @classmethod
+    def end(cls):
+        """
+        Record the end of an add-in call
+        :return: None
+        """
+        with cls.lock:
+            cls.in_flight -= 1
+            cls.last_end = time.time()
+
+    @classmethod
+    def remaining(cls):
+        """
+        :return: Seconds left in the budget, or None if no budget applies to this thread
+        """
+        budget = float(SMFConfiguration.get("recalc_budget") or 0)
+        if budget <= 0 or getattr(local, "exempt", False):
+            return None
+        with cls.lock:
+            if cls.started == 0.0:
+                return None
+            return cls.started + budget - time.time()
+
+    @classmethod
+    def check(cls, provider):
+        """
+        Check that a request may start
+        :param provider: Provider name for the error message
+        :return: Seconds left in the budget, or None if there is no budget
+        :raises DeadlineExceededError: if the budget is spent
+        """
+        remaining = cls.remaining()
+        if remaining is not None and remaining <= 0:
+            with cls.lock:
+                cls.rejected += 1
+            raise DeadlineExceededError(provider)
+        return remaining
+
+    @classmethod
+    def statistics(cls):
+        """
+        :return: Dict of budget counters
+        """
+        remaining = cls.remaining()
+        with cls.lock:
+            return {
+                "recalcs": cls.recalcs,
+                "rejected": cls.rejected,
+                "remaining": remaining,
+            }
+
+
+@contextmanager
+def exempt():
+    """
+    Run the body without a budget, e.g. for background fetches
+    """
+    previous = getattr(local, "exempt", False)
+    local.exempt = True
+    try:
+        yield
+    finally:
+        local.exempt = previous
+
+
+def recalc_call(fn):
+    """
+    Decorator for add-in functions. Marks the time the call runs as recalculation activity.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        RecalcDeadline.begin()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            RecalcDeadline.end()
+    return wrapper
@@ -0,0 +1,159 @@
+#  exchange_index.py - Ticker to exchange lookup for the SMF Extension.
+#
+#  license: GNU LGPL
+#
+#  This library is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  NOTE
+#  Morningstar and ADVFN need to know the exchange a ticker trades on.
+#  The NASDAQ, NYSE and AMEX company lists are downloaded from nasdaq.com
+#  in parallel and reduced to a symbol -> exchange dict. Only the symbol
+#  column is kept. The symbol lists are saved to exchange_index.json and
+#  reused until they are older than exchange_index_ttl seconds (a day by
+#  default), so most LibreOffice sessions never download them.
+#
+import csv
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import URLError
+from codecs import iterdecode
+from app_logger import AppLogger
+import circuit_breaker
+import http_client
+from smf_config import get_smf_dir, SMFConfiguration
+
+# Logger init
+app_logger = AppLogger("smf-extension")
+logger = app_logger.getAppLogger()
+
+# nasdaq.com exchange name -> exchange code, lowest lookup precedence first
+EXCHANGES = [('amex', 'XASE'), ('nyse', 'XNYS'), ('nasdaq', 'XNAS')]
+
+
+class ExchangeIndex:
+    """
+    Process wide symbol -> exchange code index
+    """
+    lock = threading.Lock()
+    # exchange code -> list of symbols
+    symbol_lists = {}
+    # symbol -> exchange code
+    index = {}
+    built = 0.0
+    full_file_path = ""
+
+    @classmethod
+    def find_exchange(cls, ticker):
+        """
+        Determine exchange ticker is traded on for querying data providers
+        :param ticker:
+        :return: XNAS, XNYS, XASE or an error message
+        """
+        with cls.lock:
+            if time.time() - cls.built > float(SMFConfiguration.get("exchange_index_ttl")):
+                cls.__refresh()
+            exchange = cls.index.get(ticker)
+        if exchange is None:
+            return 'Exchange lookup failed. Only NYSE, NASDAQ, and AMEX are supported.'
+        return exchange
+
+    @classmethod
+    def __refresh(cls):
+        """
+        Load the saved index, downloading the symbol lists if it is missing or out of date.
+        The caller must hold the lock.
+        """
+        cls.full_file_path = get_smf_dir() + "exchange_index.json"
+        if not cls.symbol_lists:
+            cls.__load()
+        if time.time() - cls.built <= float(SMFConfiguration.get("exchange_index_ttl")):
+            return
+
+        # Download all lists at the same time
+        with ThreadPoolExecutor(max_workers=len(EXCHANGES)) as executor:
+            results = list(executor.map(query_nasdaq, [name for name, code in EXCHANGES]))
+
+        complete = True
+        for (name, code), symbols in zip(EXCHANGES, results):
+            if symbols is None:
+                # Keep whatever we had for this exchange
+                complete = False
+            else:
+                cls.symbol_lists[code] = symbols
+        cls.__build_index()
+        if complete:
+            cls.built = time.time()
+            cls.__save()
+        else:
+            # Try again on a later lookup, but not on every one
+            cls.built = time.time() - float(SMFConfiguration.get("exchange_index_ttl")) + 15 * 60
+
+    @classmethod
+    def __build_index(cls):
+        cls.index = {}
+        for name, code in EXCHANGES:
+            for symbol in cls.symbol_lists.get(code, []):
+                cls.index[symbol] = code
+
+    @classmethod
+    def __load(cls):
+        try:
+            with open(cls.full_file_path, "r") as f:
+                saved = json.load(f)
+            cls.symbol_lists = saved["exchanges"]
+            cls.built = float(saved["built"])
+            cls.__build_index()
+            logger.debug("Loaded %d symbols from %s", len(cls.index), cls.full_file_path)
+        except FileNotFoundError:
+            logger.debug("%s was not found", cls.full_file_path)
+        except Exception as ex:
+            logger.debug("An exception occurred while attempting to load %s", cls.full_file_path)
+            logger.debug(str(ex))
+
+    @classmethod
+    def __save(cls):
+        try:
+            with open(cls.full_file_path, "w") as f:
+                json.dump({"built": cls.built, "exchanges": cls.symbol_lists}, f)
+        except Exception as ex:
+            logger.error("Unable to save %s: %s", cls.full_file_path, str(ex))
+
+
+def query_nasdaq(exch_name):
+    """
+    Query Nasdaq for list of tickers by exchange
+    :param exch_name: nasdaq, nyse or amex
+    :return: List of symbols or None if the download failed
+    """
+    header = {'user-agent': 'Mozilla/5.0 '\
+              '(Macintosh; Intel Mac OS X 10.9; rv:32.0)'\
+              ' Gecko/20100101 Firefox/32.0',}
+    url = 'http://www.nasdaq.com/screening/companies-by-name.aspx?letter=0'\
+          '&exchange=%s&render=download' % (exch_name)
+    try:
+        symbols = circuit_breaker.call('nasdaq', download_nasdaq, url, header)
+    except (URLError, IOError) as e:
+        logger.error("Unable to download %s company list: %s", exch_name, str(e))
+        return None
+    return [s for s in symbols[1:] if s]
+
+
+def download_nasdaq(url, header):
+    """
+    Download a company list
+    :return: The symbol column, including the header row
+    """
+    with http_client.get(url, headers = header, revalidate = True, provider = 'nasdaq') as response:
+        exch_result = csv.reader(iterdecode(response,'utf-8'))
+        # Keep only the symbol column
+        return [row[0].strip() for row in exch_result if row]
+
+
+def find_exchange(ticker):
+    """Determine exchange ticker is traded on for querying data providers"""
+    return ExchangeIndex.find_exchange(ticker)
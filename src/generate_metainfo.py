@@ -107,14 +107,14 @@ define_function(smf_xml, \
     [('a', 'The ticker symbol.'), ('b', 'The data code.')])
 define_function(smf_xml, \
     'getMorningKey', 'Fetches Morningstar Key Ratios (11yr).', \
-    [('a', 'The ticker symbol.'), ('b', 'The data code.')])
+    [('a', 'The ticker symbol.'), ('b', 'The data code or name.')])
 define_function(smf_xml, \
     'getMorningFin', 'Fetches Morningstar Financials (5yr).', \
-    [('a', 'The ticker symbol.'), ('b', 'The data code.')])
+    [('a', 'The ticker symbol.'), ('b', 'The data code or name.')])
 
 define_function(smf_xml, \
     'getMorningQFin', 'Fetches Morningstar Quarterly Financials (5qtr).', \
-    [('a', 'The ticker symbol.'), ('b', 'The data code.')])
+    [('a', 'The ticker symbol.'), ('b', 'The data code or name.')])
 
 define_function(smf_xml, \
     'getYahooHist', 'Fetches Yahoo Financial Historical Data', \
@@ -128,6 +128,15 @@ define_function(smf_xml, \
     'getIntrinioQuote', 'Fetches Historical Closing Quote from Intrinio', \
     [('a', 'The ticker symbol.'), ('b', 'The date.')])
 
+define_function(smf_xml, \
+    'getHistoricalSeries', 'Fetches a Range of Historical Quotes as an Array', \
+    [('a', 'The ticker symbol.'), ('b', 'The start date.'), ('c', 'The end date.'),
+     ('[d]', 'The data names (e.g. Date,Close).')])
+
+define_function(smf_xml, \
+    'getIntrinioRange', 'Loads a Range of Historical Closing Quotes from Intrinio', \
+    [('a', 'The ticker symbols.'), ('b', 'The start date.'), ('c', 'The end date.')])
+
 smf_xml.write('</node>\n')
 smf_xml.write('</node>\n')
 smf_xml.write('</node>\n')
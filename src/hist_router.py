@@ -0,0 +1,231 @@
+#  hist_router.py - Historical quote provider selection for the SMF Extension.
+#
+#  license: GNU LGPL
+#
+#  This library is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  NOTE
+#  Historical quotes come from several sources that each break from time
+#  to time. On a cache miss the router asks the providers listed in the
+#  hist_providers setting, best first, until one returns quotes:
+#
+#  * google_csv - Google Finance CSV export
+#  * google_html - Google Finance historical page
+#  * wsj - Wall Street Journal historical prices page
+#  * intrinio - Intrinio API, when intrinio.conf is set up and calls are left today
+#
+#  Providers are ranked by their recent latency divided by their recent
+#  success rate, both kept as moving averages. An answer without quotes
+#  counts as half a success, so a source that has the data wins over one
+#  that is fast but empty. Providers whose circuit
+#  breaker is open are skipped until their backoff has passed. Providers that have not been tried yet
+#  keep their hist_providers order. Whatever a provider returns is written
+#  to the quote cache, so every historical function can use it.
+#
+
+import threading
+import time
+from urllib.error import URLError, HTTPError
+from app_logger import AppLogger
+from smf_config import SMFConfiguration
+from deadline import DeadlineExceededError
+import circuit_breaker
+import html_hist_quote
+import single_flight
+import wsj_hist
+
+# Logger init
+app_logger = AppLogger("smf-extension")
+logger = app_logger.getAppLogger()
+
+# Weight of the newest sample in the moving averages
+SMOOTHING = 0.3
+# Latency assumed for a provider that has not been tried yet
+DEFAULT_LATENCY = 2.0
+# Lowest success rate used for ranking, so a failing provider still has a rank
+MIN_SUCCESS_RATE = 0.05
+
+
+class HistProvider:
+    """
+    One historical quote source and its observed performance
+    """
+    def __init__(self, name, breaker, download, available=None, guarded=False):
+        """
+        :param name: Name used in hist_providers
+        :param breaker: Circuit breaker provider name
+        :param download: Function(ticker, start_date, end_date) returning a list of Quotes
+        :param available: Optional function returning False when the provider can not be used
+        :param guarded: True if download already goes through the circuit breaker
+        """
+        self.name = name
+        self.breaker = breaker
+        self.download = download
+        self.available = available
+        self.guarded = guarded
+        self.lock = threading.Lock()
+        self.latency = None
+        self.success_rate = 1.0
+        self.successes = 0
+        self.failures = 0
+
+    def usable(self):
+        """
+        :return: True if the provider is set up and its breaker is not open
+        """
+        if self.available is not None and not self.available():
+            return False
+        # The breaker itself moves to half open when the request is made
+        return circuit_breaker.breakers[self.breaker].can_try()
+
+    def score(self):
+        """
+        :return: Expected cost of asking this provider, lower is better
+        """
+        with self.lock:
+            latency = DEFAULT_LATENCY if self.latency is None else self.latency
+            return latency / max(self.success_rate, MIN_SUCCESS_RATE)
+
+    def record(self, elapsed, success):
+        """
+        :param elapsed: Seconds the request took
+        :param success: 1.0 for quotes, 0.5 for an answer without quotes, 0.0 for an error
+        """
+        with self.lock:
+            if self.latency is None:
+                self.latency = elapsed
+            else:
+                self.latency += SMOOTHING * (elapsed - self.latency)
+            self.success_rate += SMOOTHING * (success - self.success_rate)
+            if success:
+                self.successes += 1
+            else:
+                self.failures += 1
+
+    def fetch(self, ticker, start_date, end_date):
+        """
+        Download through the provider's circuit breaker, recording latency and outcome
+        :return: A list of Quotes
+        """
+        started = time.time()
+        try:
+            if self.guarded:
+                quotes = self.download(ticker, start_date, end_date)
+            else:
+                quotes = circuit_breaker.call(self.breaker, self.download, ticker, start_date, end_date)
+        except DeadlineExceededError:
+            # Says nothing about the provider
+            raise
+        except Exception:
+            self.record(time.time() - started, 0.0)
+            raise
+        self.record(time.time() - started, 1.0 if quotes else 0.5)
+        return quotes
+
+    def statistics(self):
+        with self.lock:
+            return {
+                "latency": self.latency,
+                "success_rate": self.success_rate,
+                "successes": self.successes,
+                "failures": self.failures,
+            }
+
+
+def intrinio_available():
+    """Intrinio needs intrinio.conf and calls left today"""
+    return bool(html_hist_quote.QConfiguration.is_configured()) and \
+        html_hist_quote.IntrinioQuota.remaining() > 0
+
+
+def download_intrinio(ticker, start_date, end_date):
+    return html_hist_quote.Quote.get_intrinio_quotes(ticker, start_date, end_date)
+
+
+def download_google_csv(ticker, start_date, end_date):
+    return html_hist_quote.Quote.download_csv_quotes(ticker, start_date, end_date)
+
+
+def download_google_html(ticker, start_date, end_date):
+    return html_hist_quote.Quote.download_quotes(ticker, start_date, end_date)
+
+
+def download_wsj(ticker, start_date, end_date):
+    # Looked up at call time, wsj_hist may still be importing html_hist_quote
+    return wsj_hist.download_wsj_quotes(ticker, start_date, end_date)
+
+
+providers = {
+    "google_csv": HistProvider("google_csv", "google", download_google_csv),
+    "google_html": HistProvider("google_html", "google", download_google_html),
+    "wsj": HistProvider("wsj", "wsj", download_wsj),
+    "intrinio": HistProvider("intrinio", "intrinio", download_intrinio, intrinio_available, guarded=True),
+}
+
+
+def ranked_providers():
+    """
+    :return: Usable providers from hist_providers, best first
+    """
+    names = SMFConfiguration.get("hist_providers") or []
+    candidates = [providers[name] for name in names if name in providers]
+    # sorted is stable, so ties keep the configured order
+    return sorted([p for p in candidates if p.usable()], key=lambda p: p.score())
+
+
+def get_quotes(ticker, start_date, end_date):
+    """
+    Get the quotes for a date range from the best provider that has them.
+    Concurrent requests for the same range share one download.
+    :param ticker:
+    :param start_date: ISO format start date
+    :param end_date: ISO format end date
+    :return: A list of Quotes, one per trading day. None if every provider failed with an HTTP error.
+    Other errors from the last provider tried are raised.
+    """
+    return single_flight.provider_flight.do(("hist_router", ticker, (start_date, end_date)),
+                                            route, ticker, start_date, end_date)
+
+
+def route(ticker, start_date, end_date):
+    """
+    Ask the providers in rank order until one returns quotes, and cache the quotes
+    :return: See get_quotes
+    """
+    error = None
+    answered = False
+    for provider in ranked_providers():
+        try:
+            quotes = provider.fetch(ticker, start_date, end_date)
+        except DeadlineExceededError:
+            # No other provider can be asked either
+            raise
+        except Exception as ex:
+            logger.debug("%s failed for %s %s..%s: %s", provider.name, ticker, start_date, end_date, str(ex))
+            error = ex
+            continue
+        answered = True
+        if quotes:
+            logger.debug("%s returned %d quotes for %s", provider.name, len(quotes), ticker)
+            html_hist_quote.save_quotes(quotes)
+            return quotes
+    if answered or error is None or isinstance(error, HTTPError):
+        # No provider has data, or every one refused the request
+        return [] if answered else None
+    if isinstance(error, (URLError, IOError)):
+        raise error
+    raise URLError(error)
+
+
+def statistics():
+    """
+    :return: Dict of provider name -> performance counters and current rank score
+    """
+    counters = {}
+    for name, provider in providers.items():
+        counters[name] = provider.statistics()
+        counters[name]["score"] = provider.score()
+    return counters
@@ -16,12 +16,22 @@
 #  This URL produces a web page which is scraped for stock quote data. There is
 #  no guarantee that the page contents will not change over time. It may
 #  break periodically and changes to the scraping code (parsing of the
-#  web page HTML) may be required.
+#  web page HTML) may be required. The same URL with &output=csv returns
+#  the range as CSV with open, high, low, close and volume. The CSV export
+#  is tried first and the web page is the fallback.
 #
 #  7/1/2017
 #  Added support for the Intrinio financial data service (https://intrinio.com)
 #  This support provides a closing quote for a stock on a given day.
 #
+#  Intrinio allows a limited number of calls per day. Calls are counted in
+#  intrinio_quota.json next to intrinio.conf, once the circuit breaker and
+#  the recalculation budget let them through. A 429 answer is not counted.
+#  When the API reports the calls
+#  left (X-RateLimit-Remaining) or answers 429, that is used instead. Once
+#  the day's calls are spent, Intrinio cells report it without calling the
+#  API. When few calls are left, each call fetches a wider date range.
+#
 #############################################
 #
 #  Research for possible stock data sources
@@ -43,19 +53,29 @@
 #
 ##############################
 
-import urllib.request
 import urllib.parse
 import urllib.error
 from html.parser import HTMLParser
-import ssl
+import base64
+import codecs
+import csv
 import datetime
 import json
 import os
 import os.path
 from app_logger import AppLogger
+from smf_config import SMFConfiguration
+import circuit_breaker
+import deadline
+import hist_router
+import http_client
+import single_flight
+import smf_cache
+import trading_calendar
 import sys
 import threading
 import inspect
+from concurrent.futures import ThreadPoolExecutor
 
 # Logger init
 app_logger = AppLogger("smf-extension")
@@ -65,6 +85,16 @@ logger = app_logger.getAppLogger()
 # Configuration lock
 dialog_lock = threading.Lock()
 
+# Months on either side of the requested date fetched per Intrinio call when few calls are left.
+# A year of daily closes fits on one page of INTRINIO_PAGE_SIZE results.
+LOW_QUOTA_WINDOW = 6
+# Rows the Google historical page shows at most
+GOOGLE_PAGE_ROWS = 200
+# Results per Intrinio page. Longer ranges are fetched page by page.
+INTRINIO_PAGE_SIZE = 1000
+# Tickers downloaded at the same time by fetch_intrinio_range
+INTRINIO_WORKERS = 4
+
 class QConfiguration:
     """
     Encapsulates Intrinio configuration including credentials.
@@ -190,72 +220,305 @@ class QConfiguration:
 QConfiguration.load()
 
 
+class QuotaExhaustedError(Exception):
+    """
+    Raised instead of calling Intrinio once the day's calls are spent
+    """
+    pass
+
+
+class IntrinioQuota:
+    """
+    Daily Intrinio call counter, persisted in intrinio_quota.json
+    """
+    lock = threading.Lock()
+    # UTC day the counters are for
+    day = ""
+    used = 0
+    # Calls left as reported by Intrinio, None if it did not say
+    reported_remaining = None
+    rejected = 0
+    full_file_path = ""
+
+    @classmethod
+    def load(cls):
+        """
+        Load today's counters. Counters from an earlier day are dropped.
+        :return:
+        """
+        cls.full_file_path = os.path.join(os.path.dirname(QConfiguration.full_file_path),
+                                          "intrinio_quota.json")
+        try:
+            with open(cls.full_file_path, "r") as f:
+                saved = json.load(f)
+            cls.day = saved["day"]
+            cls.used = int(saved["used"])
+            cls.reported_remaining = saved.get("remaining")
+        except FileNotFoundError:
+            logger.debug("%s was not found", cls.full_file_path)
+        except Exception as ex:
+            logger.debug("An exception occurred while attempting to load %s", cls.full_file_path)
+            logger.debug(str(ex))
+        cls.__roll_over()
+
+    @classmethod
+    def __roll_over(cls):
+        # The caller holds the lock or is loading
+        today = datetime.datetime.utcnow().strftime("%Y-%m-%d")
+        if cls.day != today:
+            cls.day = today
+            cls.used = 0
+            cls.reported_remaining = None
+
+    @classmethod
+    def __save(cls):
+        try:
+            with open(cls.full_file_path, "w") as f:
+                json.dump({"day": cls.day, "used": cls.used, "remaining": cls.reported_remaining}, f)
+        except Exception as ex:
+            logger.error("Unable to save %s: %s", cls.full_file_path, str(ex))
+
+    @classmethod
+    def __remaining(cls):
+        remaining = int(SMFConfiguration.get("intrinio_daily_limit")) - cls.used
+        if cls.reported_remaining is not None:
+            remaining = min(remaining, cls.reported_remaining)
+        return max(remaining, 0)
+
+    @classmethod
+    def remaining(cls):
+        """
+        :return: Number of Intrinio calls left today
+        """
+        with cls.lock:
+            cls.__roll_over()
+            return cls.__remaining()
+
+    @classmethod
+    def is_low(cls):
+        """
+        :return: True if few enough calls are left that each should fetch as much as possible
+        """
+        return cls.remaining() <= int(SMFConfiguration.get("intrinio_low_quota"))
+
+    @classmethod
+    def __check(cls):
+        # The caller holds the lock
+        cls.__roll_over()
+        if cls.__remaining() <= 0:
+            cls.rejected += 1
+            raise QuotaExhaustedError("Intrinio daily call limit reached ({0} calls on {1} UTC)".format(
+                cls.used, cls.day))
+
+    @classmethod
+    def check(cls):
+        """
+        Make sure a call is left today without accounting for one
+        :return: None
+        :raises QuotaExhaustedError: if no calls are left today
+        """
+        with cls.lock:
+            cls.__check()
+
+    @classmethod
+    def acquire(cls):
+        """
+        Account for one Intrinio call. Call this only when the request is about to be sent.
+        :return: None
+        :raises QuotaExhaustedError: if no calls are left today
+        """
+        with cls.lock:
+            cls.__check()
+            cls.used += 1
+            if cls.reported_remaining is not None:
+                cls.reported_remaining -= 1
+            cls.__save()
+
+    @classmethod
+    def record_headers(cls, headers):
+        """
+        Take the calls left from an Intrinio response, when it says
+        :param headers: Response headers
+        :return: None
+        """
+        remaining = headers.get("X-RateLimit-Remaining") if headers is not None else None
+        if remaining is None:
+            return
+        try:
+            remaining = int(remaining)
+        except ValueError:
+            return
+        with cls.lock:
+            cls.reported_remaining = remaining
+            cls.__save()
+
+    @classmethod
+    def record_exhausted(cls):
+        """
+        Intrinio answered 429, so no calls are left today. The refused call
+        is not accounted for.
+        :return: None
+        """
+        with cls.lock:
+            cls.used = max(cls.used - 1, 0)
+            cls.reported_remaining = 0
+            cls.__save()
+
+    @classmethod
+    def statistics(cls):
+        """
+        :return: Dict of quota counters
+        """
+        with cls.lock:
+            cls.__roll_over()
+            return {"day": cls.day, "used": cls.used, "remaining": cls.__remaining(),
+                    "rejected": cls.rejected}
+
+# Initialize the Intrinio call counters
+IntrinioQuota.load()
+
+
 class HistQuoteHTMLParser(HTMLParser):
     """
     Customized parser class for web page scraping historical stock quotes.
     See the reference information at the bottom of this file to see
     how the HTML from the Google service looks.
+    The page can be fed in chunks. done is set at the end of the quote
+    table, after which the rest of the page is not needed.
     """
     def __init__(self):
         HTMLParser.__init__(self)
         # Parser state controls
         self.table_on = False
-        self.th_on = False
-        self.td_on = False
+        self.done = False
+        # "th" or "td" while inside a cell. Google does not close its cells,
+        # so a cell ends at the next cell, row or the end of the table.
+        self.cell_tag = None
+        # Text of the current cell. A chunk boundary can split it.
+        self.cell_text = []
         self.hdrs = []
         self.col = 0
+        # One dict per table row. quote_data is the most recent row.
+        self.rows = []
         self.quote_data = {}
 
     def handle_starttag(self, tag, attrs):
         if tag == "table":
-            if attrs[0][0] == "class" and attrs[0][1] == "gf-table historical_price":
+            if attrs and attrs[0][0] == "class" and attrs[0][1] == "gf-table historical_price":
                 # print ("Target table start tag:", tag, attrs[0])
                 self.table_on = True
-        elif tag == "th" and self.table_on:
-            # print("Target table th tag:", tag, attrs[0])
-            self.th_on = True
-        elif tag == "td" and self.table_on:
-            # print("Target table td tag:", tag, attrs)
-            self.td_on = True
+        elif tag == "tr" and self.table_on:
+            self.__end_cell()
+            # Each data row starts over at the first column
+            self.col = 0
+            self.quote_data = {}
+        elif tag in ("th", "td") and self.table_on:
+            self.__end_cell()
+            self.cell_tag = tag
 
     def handle_endtag(self, tag):
-        if tag == "table" and self.table_on:
+        if not self.table_on:
+            return
+        if tag in ("th", "td", "tr"):
+            self.__end_cell()
+        elif tag == "table":
             # print("Encountered target table end tag :", tag)
+            self.__end_cell()
             self.table_on = False
+            self.done = True
 
     def handle_data(self, data):
-        if self.th_on:
+        if self.cell_tag is not None:
+            self.cell_text.append(data)
+
+    def __end_cell(self):
+        if self.cell_tag is None:
+            return
+        # Be sure to remove extraneous white space
+        text = "".join(self.cell_text).strip()
+        if self.cell_tag == "th":
             # All column names are saved in lower case
-            self.hdrs.append(data.rstrip().lower())
-            self.th_on = False
-        elif self.td_on:
-            # Be sure to remove extraneous white space
-            self.quote_data[self.hdrs[self.col]] = data.rstrip()
+            self.hdrs.append(text.lower())
+        else:
+            if self.col == 0:
+                self.rows.append(self.quote_data)
+            if self.col < len(self.hdrs):
+                self.quote_data[self.hdrs[self.col]] = text
             self.col += 1
-            self.td_on = False
+        self.cell_tag = None
+        self.cell_text = []
+
+class IntrinioSession:
+    """
+    Everything an Intrinio call needs that only depends on the configuration:
+    the Authorization header, the CA file and its SSL context. Calls go through
+    the shared keep-alive pool under the session's CA file, so they reuse one
+    connection to the API. A new session is made when the configuration changes.
+    """
+    lock = threading.Lock()
+    current = None
+
+    def __init__(self, user, password, cafile):
+        self.config = (user, password, cafile)
+        credentials = "{0}:{1}".format(user, password)
+        self.headers = {
+            "Authorization": "Basic " + base64.b64encode(credentials.encode("utf-8")).decode("ascii"),
+            "Accept": "application/json",
+        }
+        self.cafile = cafile
+        # Build the SSL context now rather than on the first call
+        http_client.SSLContexts.get(cafile)
+        self.calls = 0
+
+    @classmethod
+    def get(cls):
+        """
+        :return: The session for the current Intrinio configuration
+        """
+        config = (QConfiguration.auth_user, QConfiguration.auth_passwd, IntrinioBase.cafile())
+        with cls.lock:
+            if cls.current is None or cls.current.config != config:
+                cls.current = IntrinioSession(*config)
+                logger.debug("Created Intrinio session for %s", QConfiguration.get_masked_user())
+            return cls.current
+
+    def download(self, url_string):
+        """
+        Make one Intrinio call. Run through the circuit breaker, so a call is only
+        accounted for once the breaker and the recalculation budget let it through.
+        :param url_string: Intrinio API URL
+        :return: The response body
+        """
+        deadline.RecalcDeadline.check("intrinio")
+        IntrinioQuota.acquire()
+        self.calls += 1
+        try:
+            with http_client.get(url_string, headers=self.headers, cafile=self.cafile,
+                                 provider="intrinio") as response:
+                IntrinioQuota.record_headers(response.headers)
+                return response.read()
+        except urllib.error.HTTPError as ex:
+            if ex.code == 429:
+                IntrinioQuota.record_exhausted()
+            raise
+
 
 class IntrinioBase:
 
     @staticmethod
-    def setup_authorization(url_string):
-        passman = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-        passman.add_password(None, url_string, QConfiguration.auth_user, QConfiguration.auth_passwd)
-        authhandler = urllib.request.HTTPBasicAuthHandler(passman)
-
+    def cafile():
+        """
+        The LO version of python does not have any cacerts. certifi as an alternate.
+        This works on macOS 10.12.5 Sierra. Why is unclear. It literally took days to
+        find this as a working solution.
+        See: https://github.com/certifi/python-certifi and https://pypi.python.org/pypi/certifi
+        :return: The CA file for Intrinio calls, None for the http_client default
+        """
         if QConfiguration.macOS:
-            # The LO version of python does not have any cacerts. certifi as an alternate.
-            # This works on macOS 10.12.5 Sierra. Why is unclear. It literally took days to
-            # find this as a working solution.
-            # See: https://github.com/certifi/python-certifi and https://pypi.python.org/pypi/certifi
             if not QConfiguration.cacerts:
-                logger("Intrinio call will fail because intrinio.conf certfi key is invalid or missing")
-            ssl_ctx = ssl.create_default_context(cafile=QConfiguration.cacerts)
-            httpshandler = urllib.request.HTTPSHandler(context=ssl_ctx)
-            opener = urllib.request.build_opener(httpshandler, authhandler)
-        else:
-            opener = urllib.request.build_opener(authhandler)
-
-        urllib.request.install_opener(opener)
+                logger.error("Intrinio call will fail because intrinio.conf certfi key is invalid or missing")
+            return QConfiguration.cacerts
+        return None
 
 
     @staticmethod
@@ -267,10 +530,12 @@ class IntrinioBase:
         """
         global logger
         print(url_string)
-        Quote.setup_authorization(url_string)
+        session = IntrinioSession.get()
+        # Fail fast without a call left, the call is accounted for in download
+        IntrinioQuota.check()
         try:
             logger.debug("Calling Intrinio API: %s", url_string)
-            res = urllib.request.urlopen(url_string).read()
+            res = circuit_breaker.call("intrinio", session.download, url_string)
             res = str(res, "utf-8")
         except urllib.error.HTTPError as ex:
             logger.debug("Exception attempting to call Intrinio API")
@@ -283,38 +548,148 @@ class Quote(IntrinioBase):
     """
     A historical quote for a given ticker symbol
     """
-    def __init__(self, ticker, for_date, close):
+    def __init__(self, ticker, for_date, close, open_=0, high=0, low=0, volume=0):
         self.close = close
         self.for_date = for_date
         self.ticker = ticker
+        self.open = open_
+        self.high = high
+        self.low = low
+        self.volume = volume
+
+    def cache_row(self):
+        """
+        The quote as a SymbolDate record. The Google service does not
+        produce all data values for every symbol (e.g. mutual funds only have closing prices).
+        to preserve backward compatiblity in the cache DB zero values are used for unavailable values.
+        :return: [Symbol, Date, Open, High, Low, Close, Volume, Adj_Close]
+        """
+        return [self.ticker, self.for_date, self.open, self.high, self.low, self.close, self.volume, 0]
+
+    def has_ohlc(self):
+        """
+        :return: True if the quote has more than a closing price
+        """
+        return bool(self.open or self.high or self.low)
+
+    @staticmethod
+    def from_rows(ticker, rows, date_format):
+        """
+        Convert rows from a historical quote page or CSV export to Quotes
+        :param ticker:
+        :param rows: List of dicts keyed by lower case column name
+        :param date_format: strptime format of the date column
+        :return: A list of Quotes. Rows that can not be converted are skipped.
+        """
+        quotes = []
+        for row in rows:
+            try:
+                for_date = datetime.datetime.strptime(row["date"], date_format).strftime("%Y-%m-%d")
+                quotes.append(Quote(ticker, for_date, google_number(row["close"]),
+                                    open_=google_number(row.get("open")),
+                                    high=google_number(row.get("high")),
+                                    low=google_number(row.get("low")),
+                                    volume=google_number(row.get("volume"))))
+            except (KeyError, ValueError) as ex:
+                logger.debug("Skipping Google Finance row %s: %s", row, str(ex))
+        return quotes
 
     @staticmethod
     def get_quote(ticker, start_date):
-        url_string = "https://finance.google.com/finance/historical?q={0}".format(ticker)
-        url_string_opt = "&startdate={0}&enddate={0}".format(
-                          start_date)
-        uue_url_string = url_string + url_string_opt
-        # print (url_string)
+        """
+        Get the closing quote for a single date from Google
+        :param ticker:
+        :param start_date:
+        :return: A Quote or None if the date is not available.
+        """
+        quotes = Quote.get_quotes(ticker, start_date, start_date)
+        if not quotes:
+            return None
+        return quotes[0]
 
-        # Get the web page source
+    @staticmethod
+    def get_quotes(ticker, start_date, end_date):
+        """
+        Get the closing quotes for a date range from Google in one request.
+        Concurrent requests for the same range share one download.
+        :param ticker:
+        :param start_date: ISO format start date
+        :param end_date: ISO format end date
+        :return: A list of Quotes, one per trading day. None if the call failed.
+        """
         try:
-            logger.debug("Calling Google Finance: %s", uue_url_string)
-            html_lines = urllib.request.urlopen(uue_url_string).readlines()
-            html_str = ""
-            for line in html_lines:
-                html_str += str(line, "utf-8")
+            return single_flight.provider_flight.do(("google", ticker, (start_date, end_date)),
+                                                    circuit_breaker.call, "google",
+                                                    Quote.download_google_quotes, ticker, start_date, end_date)
         except urllib.error.HTTPError as ex:
             logger.debug("Exception attempting to call Google Finance")
             logger.debug(ex.msg)
             return None
 
-        # Run parser over page source, extracting data of interest
-        parser = HistQuoteHTMLParser()
-        parser.feed(html_str)
+    @staticmethod
+    def download_google_quotes(ticker, start_date, end_date):
+        """
+        Download a date range from Google, preferring the CSV export, which has
+        every row of the range with open, high, low and volume. The web page
+        is used if the export fails.
+        :param ticker:
+        :param start_date: ISO format start date
+        :param end_date: ISO format end date
+        :return: A list of Quotes, one per trading day. Raises HTTPError if the call failed.
+        """
+        try:
+            return Quote.download_csv_quotes(ticker, start_date, end_date)
+        except (urllib.error.HTTPError, ValueError) as ex:
+            logger.debug("Google Finance CSV export failed for %s, using the web page: %s", ticker, str(ex))
+        return Quote.download_quotes(ticker, start_date, end_date)
 
-        print (parser.quote_data)
+    @staticmethod
+    def download_csv_quotes(ticker, start_date, end_date):
+        """
+        Download and parse the Google historical CSV export for a date range
+        :param ticker:
+        :param start_date: ISO format start date
+        :param end_date: ISO format end date
+        :return: A list of Quotes, one per trading day. Raises HTTPError if the call
+        failed and ValueError if the response is not the CSV export.
+        """
+        url_string = "https://finance.google.com/finance/historical?q={0}" \
+                     "&startdate={1}&enddate={2}&output=csv".format(ticker, start_date, end_date)
+        logger.debug("Calling Google Finance: %s", url_string)
+        with http_client.get(url_string, provider="google") as response:
+            # The export starts with a byte order mark: Date,Open,High,Low,Close,Volume
+            reader = csv.reader(codecs.iterdecode(response, "utf-8-sig"))
+            hdrs = [h.strip().lower() for h in next(reader, [])]
+            if "date" not in hdrs or "close" not in hdrs:
+                raise ValueError("Unexpected Google Finance CSV header {0}".format(hdrs))
+            rows = [dict(zip(hdrs, row)) for row in reader if row]
+        # Dates look like 31-May-17
+        return Quote.from_rows(ticker, rows, "%d-%b-%y")
 
-        return Quote(ticker, start_date, float(parser.quote_data["close"].replace(",", "")))
+    @staticmethod
+    def download_quotes(ticker, start_date, end_date):
+        """
+        Download and parse the Google historical page for a date range
+        :param ticker:
+        :param start_date: ISO format start date
+        :param end_date: ISO format end date
+        :return: A list of Quotes, one per trading day. Raises HTTPError if the call failed.
+        """
+        url_string = "https://finance.google.com/finance/historical?q={0}".format(ticker)
+        # num asks for up to GOOGLE_PAGE_ROWS rows on a single page
+        url_string_opt = "&startdate={0}&enddate={1}&num={2}".format(
+                          start_date, end_date, GOOGLE_PAGE_ROWS)
+        uue_url_string = url_string + url_string_opt
+        # print (url_string)
+
+        # Get the web page source
+        logger.debug("Calling Google Finance: %s", uue_url_string)
+        with http_client.get(uue_url_string, provider="google") as response:
+            # Run parser over page source as it arrives, extracting data of interest
+            parser = parse_google_page(response, response.headers.get_content_charset())
+
+        # Dates look like May 31, 2017
+        return Quote.from_rows(ticker, parser.rows, "%b %d, %Y")
 
     @staticmethod
     def get_intrinio_quote(ticker, start_date):
@@ -332,6 +707,475 @@ class Quote(IntrinioBase):
         # Extract closing price from json result
         return Quote(ticker, start_date, float(res["data"][0]["value"]))
 
+    @staticmethod
+    def get_intrinio_quotes(ticker, start_date, end_date):
+        """
+        Get the closing quotes for a date range from Intrinio in one request.
+        Concurrent requests for the same range share one download.
+        :param ticker:
+        :param start_date: ISO format start date
+        :param end_date: ISO format end date
+        :return: A list of Quotes, one per trading day.
+        """
+        return single_flight.provider_flight.do(("intrinio", ticker, (start_date, end_date)),
+                                                Quote.download_intrinio_quotes, ticker, start_date, end_date)
+
+    @staticmethod
+    def download_intrinio_quotes(ticker, start_date, end_date):
+        """
+        Download the closing quotes for a date range from Intrinio
+        :param ticker:
+        :param start_date: ISO format start date
+        :param end_date: ISO format end date
+        :return: A list of Quotes, one per trading day.
+        """
+        quotes = []
+        for data in Quote.intrinio_pages(ticker, start_date, end_date):
+            # Each data item looks like {"date": "2017-05-31", "value": 10.68}
+            for d in data:
+                try:
+                    quotes.append(Quote(ticker, d["date"], float(d["value"])))
+                except (KeyError, TypeError, ValueError) as ex:
+                    logger.debug("Skipping Intrinio item %s: %s", d, str(ex))
+        return quotes
+
+    @staticmethod
+    def intrinio_pages(ticker, start_date, end_date):
+        """
+        Request a date range page by page. Each page is one Intrinio call.
+        :param ticker:
+        :param start_date: ISO format start date
+        :param end_date: ISO format end date
+        :return: Generator of the data list of each page
+        """
+        template_url = "{0}/historical_data?identifier={1}&item=close_price&start_date={2}&end_date={3}" \
+                       "&page_size={4}&page_number={5}"
+        page_number = 1
+        while True:
+            url_string = template_url.format(QConfiguration.base_url, ticker, start_date, end_date,
+                                             INTRINIO_PAGE_SIZE, page_number)
+            res = Quote.exec_request(url_string)
+            data = res.get("data") or []
+            if data:
+                yield data
+            if not data or page_number >= int(res.get("total_pages") or 1):
+                return
+            page_number += 1
+
+
+def google_number(value):
+    """
+    Convert a Google Finance number like 6,221.63. Google shows - for a missing value.
+    :param value: string or None
+    :return: float, 0 for a missing value
+    """
+    if value is None:
+        return 0
+    value = value.strip().replace(",", "")
+    if value in ("", "-"):
+        return 0
+    return float(value)
+
+
+def save_quotes(quotes):
+    """
+    Cache quotes. Quotes with open/high/low values replace cached close only
+    records. Close only quotes never replace a cached record.
+    :param quotes: List of Quotes
+    :return: None
+    """
+    smf_cache.upsert_quotes([q.cache_row() for q in quotes if q.has_ohlc()])
+    smf_cache.insert_quotes([q.cache_row() for q in quotes if not q.has_ohlc()])
+
+
+def parse_google_page(response, charset):
+    """
+    Feed a Google historical page to the parser in chunks until the quote table ends.
+    The rest of the page is not downloaded.
+    :param response: http_client response
+    :param charset: Page charset from the response headers or None
+    :return: HistQuoteHTMLParser holding the quote rows
+    """
+    parser = HistQuoteHTMLParser()
+    decoder = codecs.getincrementaldecoder(charset or "utf-8")(errors="replace")
+    while not parser.done:
+        chunk = response.read(http_client.CHUNK_SIZE)
+        if not chunk:
+            parser.feed(decoder.decode(b"", final=True))
+            parser.close()
+            break
+        parser.feed(decoder.decode(chunk))
+    return parser
+
+
+def fetch_intrinio_range(tickers, start_date, end_date):
+    """
+    Download the closing quotes for several tickers over a date range from Intrinio
+    and cache all of them in one transaction. Each ticker costs one call per page.
+    :param tickers: List of ticker symbols
+    :param start_date: ISO format start date
+    :param end_date: ISO format end date
+    :return: Dict of ticker -> list of Quotes, or the exception that ticker's download raised
+    """
+    def download(ticker):
+        try:
+            return Quote.get_intrinio_quotes(ticker, start_date, end_date)
+        except Exception as ex:
+            return ex
+
+    tickers = list(dict.fromkeys(tickers))
+    with ThreadPoolExecutor(max_workers=max(min(len(tickers), INTRINIO_WORKERS), 1)) as executor:
+        results = dict(zip(tickers, executor.map(download, tickers)))
+    rows = []
+    for quotes in results.values():
+        if not isinstance(quotes, Exception):
+            rows.extend(q.cache_row() for q in quotes)
+    smf_cache.insert_quotes(rows)
+    return results
+
+
+def load_intrinio_range(self, tickers, start_tgtdate, end_tgtdate):
+    """
+    Load the closing quotes for several tickers over a date range from Intrinio into
+    the cache, so later GETINTRINIOQUOTE and GETHISTORICALSERIES cells are answered
+    without further calls.
+    :param tickers: string - comma separated ticker symbols, or a cell range of ticker symbols
+    :param start_tgtdate: string or float (libreoffice date) - first date of interest
+    :param end_tgtdate: string or float (libreoffice date) - last date of interest
+    :return: Tuple of (ticker, number of quotes loaded or error message) rows.
+    On error a 1x1 array with the message.
+    """
+    start_date = __resolve_date(start_tgtdate)
+    end_date = __resolve_date(end_tgtdate)
+    if start_date is None or end_date is None:
+        return (("Unsuported date format type",),)
+    if start_date > end_date:
+        start_date, end_date = end_date, start_date
+
+    # A cell range arrives as a tuple of row tuples
+    if isinstance(tickers, (tuple, list)):
+        cells = [c for r in tickers for c in r]
+    else:
+        cells = str(tickers).replace(";", ",").split(",")
+    symbols = [str(c).strip().upper() for c in cells if c is not None and str(c).strip()]
+    if not symbols:
+        return (("No ticker symbols given",),)
+
+    # We need intrinio.conf to use Intrinio
+    if not QConfiguration.is_configured():
+        return (("intrinio.conf is missing, incomplete or in error",),)
+
+    results = fetch_intrinio_range(symbols, start_date, end_date)
+    loaded = []
+    for symbol, quotes in results.items():
+        if isinstance(quotes, Exception):
+            loaded.append((symbol, str(quotes)))
+        else:
+            loaded.append((symbol, float(len(quotes))))
+    return tuple(loaded)
+
+
+def lookup_cached(ticker, tgtdate):
+    """
+    Answer a historical quote request from the caches only, without any network call
+    :param ticker: string - stock ticker symbol (e.g XOM)
+    :param tgtdate: string or float (libreoffice date) - for date of interest
+    :return: The value fetch_data would return, or None if answering requires a network call.
+    """
+    eff_date = __resolve_date(tgtdate)
+    if eff_date is None:
+        # fetch_data reports the error without a network call
+        return None
+    eff_date, msg = trading_calendar.resolve(eff_date)
+    if msg is not None:
+        return msg
+    cr = smf_cache.lookup_symbol_date(ticker, eff_date)
+    if cr:
+        cv = cr["Close"]
+        try:
+            return float(cv)
+        except:
+            return str(cv)
+    return __lookup_no_data(ticker, eff_date)
+
+
+def fetch_series(self, ticker, start_tgtdate, end_tgtdate, fields):
+    """
+    Retrieve a range of historical stock quotes as a 2-D array suitable for an
+    array formula. The range is served from the cache with a single query. Dates
+    missing from the cache are backfilled from the best provider with a single request.
+    :param ticker: string - stock ticker symbol (e.g XOM)
+    :param start_tgtdate: string or float (libreoffice date) - first date of interest
+    :param end_tgtdate: string or float (libreoffice date) - last date of interest
+    :param fields: string - comma separated list of column names
+    (Symbol, Date, Open, High, Low, Close, Volume, Adj_Close). Defaults to Date,Close.
+    :return: Tuple of row tuples, one row per trading day. On error a 1x1 array with the message.
+    """
+    start_date = __resolve_date(start_tgtdate)
+    end_date = __resolve_date(end_tgtdate)
+    if start_date is None or end_date is None:
+        return (("Unsuported date format type",),)
+    if start_date > end_date:
+        start_date, end_date = end_date, start_date
+
+    # Resolve the requested columns
+    if not fields:
+        fields = "Date,Close"
+    columns = []
+    for f in fields.replace(";", ",").split(","):
+        f = f.strip()
+        if not f:
+            continue
+        # Coerce datacode to Xxxxxx...We know that but the user may not get it right
+        c = "Adj_Close" if f.lower() == "adj_close" else f.capitalize()
+        if c not in SERIES_COLUMNS:
+            return (("Invalid field name: {0}".format(f),),)
+        columns.append(c)
+
+    # One range query for everything that is already cached
+    rows = smf_cache.lookup_symbol_range(ticker, start_date, end_date)
+
+    # Backfill any gaps, one request per range of up to GOOGLE_PAGE_ROWS trading days
+    gaps = __find_gaps(ticker, start_date, end_date, set(r["Date"] for r in rows))
+    if gaps:
+        logger.debug("Backfilling %d dates for %s", len(gaps), ticker)
+        fetched = False
+        for first, last in __gap_ranges(gaps):
+            # The router caches whatever it gets
+            quotes = hist_router.get_quotes(ticker, first, last)
+            if not quotes:
+                continue
+            fetched = True
+            # Dates the provider covered but did not return are holidays or have no data.
+            # Outside that span the provider may just have stopped early.
+            have = set(q.for_date for q in quotes)
+            covered_from, covered_to = min(have), max(have)
+            for d in gaps:
+                if covered_from <= d <= covered_to and d not in have:
+                    smf_cache.negative_cache.put((ticker, d), "No quote available for {0} on {1}".format(ticker, d))
+        if fetched:
+            rows = smf_cache.lookup_symbol_range(ticker, start_date, end_date)
+
+    if not rows:
+        return (("No quotes available for {0} from {1} to {2}".format(ticker, start_date, end_date),),)
+
+    series = []
+    for r in rows:
+        series_row = []
+        for c in columns:
+            cv = r[c]
+            try:
+                v = float(cv)
+            except:
+                v = str(cv)
+            series_row.append(v)
+        series.append(tuple(series_row))
+    return tuple(series)
+
+
+# Column names that can be requested from fetch_series
+SERIES_COLUMNS = ["Symbol", "Date", "Open", "High", "Low", "Close", "Volume", "Adj_Close"]
+
+
+def __gap_ranges(gaps):
+    """
+    Split gap dates into ranges that each span at most GOOGLE_PAGE_ROWS trading
+    days, so no single request can be cut short by the page size
+    :param gaps: Sorted list of ISO format trading dates
+    :return: List of ISO format (start date, end date) tuples
+    """
+    # Position of every trading day from the first gap to the last
+    position = {}
+    d = datetime.datetime.strptime(gaps[0], "%Y-%m-%d").date()
+    last = datetime.datetime.strptime(gaps[-1], "%Y-%m-%d").date()
+    while d <= last:
+        if trading_calendar.is_trading_day(d):
+            position[d.strftime("%Y-%m-%d")] = len(position)
+        d += datetime.timedelta(days=1)
+
+    ranges = []
+    for ds in gaps:
+        if ranges and position[ds] - position[ranges[-1][0]] < GOOGLE_PAGE_ROWS:
+            ranges[-1][1] = ds
+        else:
+            ranges.append([ds, ds])
+    return [tuple(r) for r in ranges]
+
+
+def __find_gaps(ticker, start_date, end_date, cached_dates):
+    """
+    Find the trading days in a range that are neither cached nor known to have no data.
+    Dates after today are never gaps.
+    :param ticker:
+    :param start_date: ISO format date
+    :param end_date: ISO format date
+    :param cached_dates: set of ISO format dates that are in the cache
+    :return: Sorted list of ISO format dates
+    """
+    gaps = []
+    d = datetime.datetime.strptime(start_date, "%Y-%m-%d").date()
+    last = min(datetime.datetime.strptime(end_date, "%Y-%m-%d").date(), datetime.date.today())
+    while d <= last:
+        ds = d.strftime("%Y-%m-%d")
+        if trading_calendar.is_trading_day(d) and ds not in cached_dates and \
+                smf_cache.negative_cache.get((ticker, ds)) is None:
+            gaps.append(ds)
+        d += datetime.timedelta(days=1)
+    return gaps
+
+
+def __resolve_date(tgtdate):
+    """
+    Resolve a date. It can be a LibreCalc date as a float or a string date.
+    :param tgtdate: string or float (libreoffice date)
+    :return: ISO format date string or None if the type is not supported
+    """
+    if type(tgtdate) == float:
+        return __float_to_date_str(tgtdate)
+    elif type(tgtdate) == str:
+        # Assumed to be a string in ISO format.
+        return tgtdate
+    logger.debug("Unsuported date format type: {0} value: {1}".format(type(tgtdate), tgtdate))
+    return None
+
+
+def __lookup_no_data(ticker, eff_date):
+    """
+    Check the negative cache for a recent "no data" answer
+    :param ticker:
+    :param eff_date: ISO format date of interest
+    :return: The remembered error message or None
+    """
+    msg = smf_cache.negative_cache.get((ticker, None))
+    if msg is None:
+        msg = smf_cache.negative_cache.get((ticker, eff_date))
+    if msg is not None:
+        logger.debug("Negative cache hit for %s %s", ticker, eff_date)
+    return msg
+
+
+def __remember_no_data(ticker, eff_date):
+    """
+    Remember that the provider had no quote for a ticker/date pair
+    :param ticker:
+    :param eff_date: ISO format date of interest
+    :return: Error message for the cell
+    """
+    msg = "No quote available for {0} on {1}".format(ticker, eff_date)
+    smf_cache.negative_cache.put((ticker, eff_date), msg)
+    return msg
+
+
+def __remember_unknown_symbol(ticker, ex):
+    """
+    Remember that the provider does not know a ticker. Only client
+    errors (4xx) are remembered. Anything else is re-raised.
+    :param ticker:
+    :param ex: HTTPError from the provider
+    :return: Error message for the cell
+    """
+    if ex.code < 400 or ex.code >= 500 or ex.code == 401 or ex.code == 429:
+        raise ex
+    msg = "Unknown symbol {0} ({1})".format(ticker, ex.code)
+    smf_cache.negative_cache.put((ticker, None), msg)
+    return msg
+
+
+def __prefetch_range(eff_date):
+    """
+    Compute the date range fetched on a cache miss. The range is centered on the
+    requested date and extends prefetch_window days or months on either side. It
+    never extends past today.
+    :param eff_date: ISO format date of interest
+    :return: ISO format (start date, end date) tuple. A date that is not in ISO
+    format is passed to the provider as a one day range, as before prefetching.
+    """
+    window = int(SMFConfiguration.get("prefetch_window"))
+    try:
+        tgt = datetime.datetime.strptime(eff_date, "%Y-%m-%d").date()
+    except ValueError:
+        return eff_date, eff_date
+    if SMFConfiguration.get("prefetch_unit") == "months":
+        start = __add_months(tgt, -window)
+        end = __add_months(tgt, window)
+    else:
+        start = tgt - datetime.timedelta(days=window)
+        end = tgt + datetime.timedelta(days=window)
+    end = max(min(end, datetime.date.today()), tgt)
+    return start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
+
+
+def __low_quota_range(eff_date, start_date, end_date):
+    """
+    Widen a prefetch range to LOW_QUOTA_WINDOW months on either side of the requested date
+    :param eff_date: ISO format date of interest
+    :param start_date: ISO format start of the normal prefetch range
+    :param end_date: ISO format end of the normal prefetch range
+    :return: ISO format (start date, end date) tuple
+    """
+    try:
+        tgt = datetime.datetime.strptime(eff_date, "%Y-%m-%d").date()
+    except ValueError:
+        return start_date, end_date
+    start = min(__add_months(tgt, -LOW_QUOTA_WINDOW).strftime("%Y-%m-%d"), start_date)
+    end = max(min(__add_months(tgt, LOW_QUOTA_WINDOW), datetime.date.today()), tgt).strftime("%Y-%m-%d")
+    return start, max(end, end_date)
+
+
+def __add_months(d, months):
+    """
+    Add a (possibly negative) number of months to a date, clamping the day to the target month
+    :param d: datetime.date
+    :param months: int
+    :return: datetime.date
+    """
+    month_index = d.year * 12 + d.month - 1 + months
+    year, month = divmod(month_index, 12)
+    month += 1
+    # Last day of target month
+    next_month = datetime.date(year + (month // 12), (month % 12) + 1, 1)
+    last_day = (next_month - datetime.timedelta(days=1)).day
+    return datetime.date(year, month, min(d.day, last_day))
+
+
+def __cache_quotes(ticker, eff_date, quotes):
+    """
+    Cache a set of prefetched quotes and pick out the one for the requested date
+    :param ticker:
+    :param eff_date: ISO format date of interest
+    :param quotes: List of Quotes
+    :return: The Quote for eff_date or None if it was not in the list
+    """
+    save_quotes(quotes)
+    return __pick_quote(eff_date, quotes)
+
+
+def __pick_quote(eff_date, quotes):
+    """
+    :param eff_date: ISO format date of interest
+    :param quotes: List of Quotes
+    :return: The Quote for eff_date or None if it was not in the list
+    """
+    for q in quotes:
+        if q.for_date == eff_date:
+            return q
+    # A date that is not in ISO format is requested on its own, see __prefetch_range
+    if len(quotes) == 1 and not __is_iso_date(eff_date):
+        return quotes[0]
+    return None
+
+
+def __is_iso_date(eff_date):
+    """
+    :param eff_date: Date string
+    :return: True if eff_date is an ISO format date
+    """
+    try:
+        datetime.datetime.strptime(eff_date, "%Y-%m-%d")
+    except ValueError:
+        return False
+    return True
+
 
 def fetch_data(self, ticker, tgtdate):
     """
@@ -351,12 +1195,17 @@ def fetch_data(self, ticker, tgtdate):
         logger.debug("Unsuported date format type: {0} value: {1}".format(type(tgtdate), tgtdate))
         return "Unsuported date format type: {0} value: {1}".format(type(tgtdate), tgtdate)
 
+    # Weekends and holidays resolve to a trading session without any I/O
+    eff_date, msg = trading_calendar.resolve(eff_date)
+    if msg is not None:
+        return msg
+
     # return "type: {0} value: {1}".format(type(tgtdate), eff_date)
 
     # Look for cache hit first...
     # Since historical data should be constant, only one web call is
     # needed for a ticker/date combination.
-    cr = __lookup_symbol_by_date(ticker, eff_date)
+    cr = smf_cache.lookup_symbol_date(ticker, eff_date)
     if cr:
         logger.debug("Google Finance cache hit for %s %s", ticker, eff_date)
         print ("Cache hit")
@@ -367,11 +1216,21 @@ def fetch_data(self, ticker, tgtdate):
             v = str(cv)
         return v
 
-    # Use Google to get historical data
-    q = Quote.get_quote(ticker, eff_date)
+    # Don't repeat a recent request that came back empty
+    msg = __lookup_no_data(ticker, eff_date)
+    if msg:
+        return msg
 
-    # Cache the quote
-    __insert_symbol(ticker, eff_date, q.close)
+    # Get historical data for the requested date and its neighbors from the
+    # best provider. The router caches the neighbors for subsequent cells.
+    start_date, end_date = __prefetch_range(eff_date)
+    quotes = hist_router.get_quotes(ticker, start_date, end_date)
+    if quotes is None:
+        return "Historical quote request failed for {0}".format(ticker)
+
+    q = __pick_quote(eff_date, quotes)
+    if q is None:
+        return __remember_no_data(ticker, eff_date)
 
     return float(q.close)
 
@@ -414,10 +1273,15 @@ def intrinio_fetch_data(self, ticker, tgtdate):
         logger.debug("Unsuported date format type: {0} value: {1}".format(type(tgtdate), tgtdate))
         return "Unsuported date format type: {0} value: {1}".format(type(tgtdate), tgtdate)
 
+    # Weekends and holidays resolve to a trading session without any I/O
+    eff_date, msg = trading_calendar.resolve(eff_date)
+    if msg is not None:
+        return msg
+
     # Look for cache hit first...
     # Since historical data should be constant, only one web call is
     # needed for a ticker/date combination.
-    cr = __lookup_symbol_by_date(ticker, eff_date)
+    cr = smf_cache.lookup_symbol_date(ticker, eff_date)
     if cr:
         logger.debug("Intrinio cache hit for %s %s", ticker, eff_date)
         cv = cr["Close"]
@@ -431,11 +1295,28 @@ def intrinio_fetch_data(self, ticker, tgtdate):
     if not QConfiguration.is_configured():
         return "intrinio.conf is missing, incomplete or in error"
 
-    # Use Intrinio to get historical data
-    q = Quote.get_intrinio_quote(ticker, eff_date)
-
-    # Cache the quote
-    __insert_symbol(ticker, eff_date, q.close)
+    # Don't repeat a recent request that came back empty
+    msg = __lookup_no_data(ticker, eff_date)
+    if msg:
+        return msg
+
+    # Use Intrinio to get historical data for the requested date and its
+    # neighbors. The neighbors are cached for subsequent cells.
+    start_date, end_date = __prefetch_range(eff_date)
+    if IntrinioQuota.is_low():
+        # Few calls left today, so make each one cover more dates
+        start_date, end_date = __low_quota_range(eff_date, start_date, end_date)
+    try:
+        quotes = Quote.get_intrinio_quotes(ticker, start_date, end_date)
+    except urllib.error.HTTPError as ex:
+        return __remember_unknown_symbol(ticker, ex)
+    except QuotaExhaustedError as ex:
+        return str(ex)
+
+    # Cache the quotes
+    q = __cache_quotes(ticker, eff_date, quotes)
+    if q is None:
+        return __remember_no_data(ticker, eff_date)
 
     return float(q.close)
 
@@ -455,84 +1336,6 @@ def __float_to_date_str(float_date):
     return eff_date
 
 
-#
-# This code was imported from the original yahoo_hist.py file. It implements a caching
-# systems using sqlite3 as the backing store.
-#
-
-import sqlite3
-import os
-
-
-def __open_yh_cache():
-    """
-    Open a connection to the cache DB. Create the DB if it does not exist.
-    :return: Database connection.
-    """
-    # Determine cache location based on underlying OS
-    file_name = "smf_yh_cache.sqlite3"
-    if os.name == "posix":
-        # Linux or OS X
-        file_path = "{0}/libreoffice/smf/".format(os.environ["HOME"])
-    elif os.name == "nt":
-        # windows
-        file_path = "{0}\\libreoffice\\smf\\".format(os.environ["LOCALAPPDATA"])
-
-    # Make the folder
-    if not os.path.exists(file_path):
-        print ("Create directory")
-        os.makedirs(file_path)
-
-    full_file_path = file_path + file_name
-
-    # If DB does not exist, create it
-    if not os.path.exists(full_file_path):
-        print ("Create database")
-        conn = sqlite3.connect(full_file_path)
-        conn.execute("CREATE TABLE SymbolDate (Symbol text not null, Date text not null, Open real, High real, Low real, Close real, Volume integer, Adj_Close real, PRIMARY KEY(Symbol,Date))")
-    else:
-        conn = sqlite3.connect(full_file_path)
-
-    # We use the row factory to get named row columns. Makes handling row sets easier.
-    conn.row_factory = sqlite3.Row
-    # The default string type is unicode. This changes it to UTF-8.
-    conn.text_factory = str
-
-    # return connection to the cache DB
-    return conn
-
-
-def __lookup_symbol_by_date(symbol, tgtdate):
-    """
-    Look up cached historical data for a given symbol/date pair.
-    :param symbol:
-    :param tgtdate:
-    :return: Returns the cached DB record. If no record is found, returns None.
-    """
-    conn = __open_yh_cache()
-    rset = conn.execute("SELECT * from SymbolDate where Symbol=? and Date=?", [symbol, tgtdate])
-    r = rset.fetchone()
-    conn.close()
-    # r will be None if no record was found
-    return r
-
-
-def __insert_symbol(symbol, tgtdate, close):
-    """
-    Insert a new cache record in the cache DB. The Google service does not
-    produce all data values for every symbol (e.g. mutual funds only have closing prices).
-    to preserve backward compatiblity in the cache DB zero values are used for unavailable values.
-    :param symbol:
-    :param tgtdate:
-    :param close:
-    :return:
-    """
-    conn = __open_yh_cache()
-    print ("Cache data:", symbol, tgtdate, close)
-    conn.execute("INSERT INTO SymbolDate values (?,?,?,?,?,?,?,?)", [symbol, tgtdate, 0, 0, 0, close, 0, 0])
-    conn.commit()
-    conn.close()
-
 #
 # Intrinio login dialog
 # Adapted from https://forum.openoffice.org/en/forum/viewtopic.php?f=45&t=56397#p248794
@@ -10,16 +10,28 @@
 #  version 3 of the License, or (at your option) any later version.
 #
 import csv
-try:
-    from urllib.request import Request, urlopen
-    from urllib.error import URLError
-except ImportError:
-    from urllib2 import Request, urlopen, URLError
+from urllib.error import URLError
 from codecs import iterdecode
 import smf
+import circuit_breaker
+import http_client
+import single_flight
+import smf_cache
 
-def query_morningstar(self, exchange, symbol, url_ending):
+def query_morningstar(exchange, symbol, url_ending):
     """Query Morningstar for the data we want"""
+    #Concurrent requests for the same report share one download.
+    rows = single_flight.provider_flight.do(('morningstar', exchange + ':' + symbol,
+                                             url_ending), circuit_breaker.call,
+                                            'morningstar', download_morningstar,
+                                            exchange, symbol, url_ending)
+    if rows is None:
+        return None
+    #Callers modify rows in place, so each gets its own copy.
+    return [list(row) for row in rows]
+
+def download_morningstar(exchange, symbol, url_ending):
+    """Download Morningstar csv. Returns a list of rows or None if it is empty"""
     #Determine whether we want key ratios or financials & query Morningstar.  
     if url_ending == '&region=usa&culture=en-US&cur=USD&order=desc':
         url = ('http://financials.morningstar.com/ajax/exportKR2CSV.html?'
@@ -27,61 +39,72 @@ def query_morningstar(self, exchange, symbol, url_ending):
     else:
         url = ('http://financials.morningstar.com/ajax/ReportProcess4CSV.html?'
                '&t=%s:%s%s' % (exchange, symbol, url_ending))
-    req = Request(url)
-    #Catch errors.
+    with http_client.get(url, revalidate=True, provider='morningstar') as response:
+        #Verify response csv isn't empty.
+        sniff = response.readline()
+        if str(sniff) == '':
+            return None
+        #Discard first line if called by fetch_keyratios().
+        if url_ending == '&region=usa&culture=en-US&cur=USD&order=desc':
+            response.readline()
+        return [row for row in csv.reader(iterdecode(response,'utf-8'))]
+
+def fetch_keyratios(self, ticker, datacode):
+    """Get Morningstar key ratio data and return desired element to user.
+    datacode is a number or a name like 'Revenue USD Mil:TTM'."""
+    #Check for sane user input for datacode.
+    name = datacode_name(datacode)
+    if name is None:
+        datacode = int(float(datacode))
+        if datacode < 1 or datacode > 946:
+            return 'Invalid Datacode'
+    #Check whether we already have the data we need.
+    stored = self.keyratio_store.get(ticker)
+    if stored is None:
+        keyratio_data = load_keyratios(self, ticker)
+        if not isinstance(keyratio_data, list):
+            return keyratio_data
+        stored = (keyratio_data, label_index(keyratio_data))
+        self.keyratio_store.put(ticker, stored)
+    keyratio_data, row_index = stored
+    #Lookup and return value from map.
+    if name is None:
+        row, col = KEYRATIO_DATACODES[datacode]
+    else:
+        row, col = resolve_name(name, row_index, keyratio_data[0])
+        if row is None:
+            return 'Invalid Datacode'
+    element = keyratio_data[row][col]
+    #Strip , from str so we can convert to float
+    return element.replace(',','')
+
+def load_keyratios(self, ticker):
+    """Load key ratios from the snapshot cache or Morningstar. Returns the
+    data as a list of rows, or an error"""
+    #Use data saved by an earlier session if it is still fresh.
+    keyratio_data = smf_cache.load_snapshot('morningstar', ticker, 'keyratios')
+    if keyratio_data is not None:
+        return keyratio_data
+    #Query NASDAQ for exchange and check for errors.
+    exchange = smf.find_exchange(self, ticker)
+    if exchange not in ['XNYS', 'XASE', 'XNAS']:
+        return exchange
+    #Query Morningstar for key ratios and check for errors.
+    url_ending = '&region=usa&culture=en-US&cur=USD&order=desc'
     try:
-        response = urlopen(req)
+        keyratio_data = query_morningstar(exchange, ticker, url_ending)
     except URLError as e:
-        self.keyratio_flag[0] = '1'
-        self.financial_flag[0] = '1'
         if hasattr(e, 'reason'):
             return e.reason
         elif hasattr(e,'code'):
             return 'Error', e.code
-    #Verify response csv isn't empty.
-    sniff = response.readline()
-    if str(sniff) == '':
-        self.keyratio_flag[0] = '1'
-        self.financial_flag[0] = '1'
+    if keyratio_data is None:
         return 'Not Available'
-    #Discard first line if called by fetch_keyratios().
-    if url_ending == '&region=usa&culture=en-US&cur=USD&order=desc':
-        response.readline()
-    return csv.reader(iterdecode(response,'utf-8'))
-
-def fetch_keyratios(self, ticker, datacode):
-    """Get Morningstar key ratio data and return desired element to user"""
-    #Check for sane user input for datacode.
-    if datacode < 1 or datacode > 946:
-        return 'Invalid Datacode'
-    #Check whether flags indicate that we already have the data we need.
-    if self.keyratio_flag[0] == '1' or self.keyratio_flag[1] != ticker:
-        #Query NASDAQ for exchange and check for errors.
-        exchange = smf.find_exchange(self, ticker)
-        if exchange not in ['XNYS', 'XASE', 'XNAS']:
-            return exchange
-        #Query Morningstar for key ratios and check for errors.
-        url_ending = '&region=usa&culture=en-US&cur=USD&order=desc'
-        self.keyratio_reader = query_morningstar(self, exchange, ticker, 
-                                                 url_ending)
-        if self.keyratio_flag[0] == '1':
-            return self.keyratio_reader
-        #Set flags and read data into memory upon successful query.
-        else:
-            self.keyratio_flag[0] = '0'
-            self.keyratio_flag[1] = ticker
-            self.keyratio_data = [row for row in self.keyratio_reader]
-            #Append day for ISO standard dates.
-            for idx in range (2, 12):
-                self.keyratio_data[0][idx] += '-01' 
-    #Check for existing datacode -> value map, if none exists then create it.
-    if not hasattr(self, 'key_datacode_map'):
-        self.key_datacode_map = keyratio_datacode_map()
-    #Lookup and return value from map.
-    row, col = self.key_datacode_map[datacode]
-    element = self.keyratio_data[row][col]
-    #Strip , from str so we can convert to float
-    return element.replace(',','')
+    #Append day for ISO standard dates.
+    for idx in range (2, 12):
+        keyratio_data[0][idx] += '-01' 
+    smf_cache.save_snapshot('morningstar', ticker, 'keyratios', keyratio_data)
+    return keyratio_data
 
 def keyratio_datacode_map():
     """Create a dictionary mapping datacodes to (row, col) in data."""
@@ -99,85 +122,101 @@ def keyratio_datacode_map():
             for datacode in range(1, 947) }
 
 def fetch_financials(self, fin_type, ticker, datacode):
-    """Get Morningstar financial data and return desired element to user"""
-    if datacode < 1 or datacode > 162:
-        return 'Invalid Datacode'
-    #Check whether flags indicate that we already have the data we need.
-    flags = self.financial_flag
-    if fin_type == 'qtr': 
-        flags = self.qfinancial_flag   
-    if flags[0] == '1' or flags[1] != ticker:
-        #Query NASDAQ for exchange and check for errors.
-        exchange = smf.find_exchange(self,ticker)
-        if exchange not in ['XNYS', 'XASE', 'XNAS']:
-            return exchange
-        #Query Morningstar for financials and check for errors.
-        if fin_type == 'qtr':      
-            url_ending = ('&region=usa&culture=en-US&cur=USD&reportType=is'
-                      '&period=3&dataType=A&order=desc&columnYear=5&rounding=3'
-                      '&view=raw&r=113199&denominatorView=raw&number=3')
-        else:
-            url_ending = ('&region=usa&culture=en-US&cur=USD&reportType=is'
-                      '&period=12&dataType=A&order=desc&columnYear=5&rounding=3'
-                      '&view=raw&r=113199&denominatorView=raw&number=3')
-        financial_reader = query_morningstar(self, exchange, ticker, url_ending)
-        if flags[0] == '1':
-            return financial_reader
-        #Set flags and read data into memory upon successful query.
-        else:
-            flags[0] = '0'
-            flags[1] = ticker
-            financial_data_setup(self, financial_reader)
-    #Check for existing datacode -> value map, if none exists then create it.
-    if not hasattr(self, 'fin_datacode_map'):
-        self.fin_datacode_map = financial_datacode_map()
+    """Get Morningstar financial data and return desired element to user.
+    datacode is a number or a name like 'Revenue:TTM'."""
+    name = datacode_name(datacode)
+    if name is None:
+        datacode = int(float(datacode))
+        if datacode < 1 or datacode > 162:
+            return 'Invalid Datacode'
+    #Annual and quarterly financials are kept separately.
+    store = self.financial_store
+    dataset = 'financials'
+    if fin_type == 'qtr':
+        store = self.qfinancial_store
+        dataset = 'qfinancials'
+    #Check whether we already have the data we need.
+    financial_data = store.get(ticker)
+    if financial_data is None:
+        financial_data = load_financials(self, fin_type, dataset, ticker)
+        if not isinstance(financial_data, list):
+            return financial_data
+        store.put(ticker, financial_data)
     #Lookup and return value from map.
-    row, col = self.fin_datacode_map[datacode]
-    element = self.financial_data[row][col]
+    if name is None:
+        row, col = FINANCIAL_DATACODES[datacode]
+    else:
+        row, col = resolve_name(name, FINANCIAL_ROW_INDEX, financial_data[0])
+        if row is None:
+            return 'Invalid Datacode'
+    element = financial_data[row][col]
     #Strip , from str so we can convert to float
     return element.replace(',','')
 
-def financial_data_setup(self, financial_reader):
+def load_financials(self, fin_type, dataset, ticker):
+    """Load financials from the snapshot cache or Morningstar. Returns the
+    data as a list of rows, or an error"""
+    #Use data saved by an earlier session if it is still fresh.
+    financial_data = smf_cache.load_snapshot('morningstar', ticker, dataset)
+    if financial_data is not None:
+        return financial_data
+    #Query NASDAQ for exchange and check for errors.
+    exchange = smf.find_exchange(self,ticker)
+    if exchange not in ['XNYS', 'XASE', 'XNAS']:
+        return exchange
+    #Query Morningstar for financials and check for errors.
+    if fin_type == 'qtr':      
+        url_ending = ('&region=usa&culture=en-US&cur=USD&reportType=is'
+                  '&period=3&dataType=A&order=desc&columnYear=5&rounding=3'
+                  '&view=raw&r=113199&denominatorView=raw&number=3')
+    else:
+        url_ending = ('&region=usa&culture=en-US&cur=USD&reportType=is'
+                  '&period=12&dataType=A&order=desc&columnYear=5&rounding=3'
+                  '&view=raw&r=113199&denominatorView=raw&number=3')
+    try:
+        financial_reader = query_morningstar(exchange, ticker, url_ending)
+    except URLError as e:
+        if hasattr(e, 'reason'):
+            return e.reason
+        elif hasattr(e,'code'):
+            return 'Error', e.code
+    if financial_reader is None:
+        return 'Not Available'
+    financial_data = financial_data_setup(financial_reader)
+    smf_cache.save_snapshot('morningstar', ticker, dataset, financial_data)
+    return financial_data
+
+def financial_data_setup(financial_reader):
     """Setup our own data structure since Morningstar csv format varies."""
-    header_list = ['Revenue', 'Cost of revenue', 'Gross profit',
-                   'Research and development', 'Sales, General and '
-                   'administrative', 'Depreciation and amortization',
-                   'Interest expense', 'Other operating expenses',
-                   'Total costs and expenses', 'Total operating expenses',
-                   'Operating income', 'Interest Expense',
-                   'Other income (expense)', 'Income before taxes',
-                   'Income before income taxes', 'Provision for income taxes',
-                   'Net income from continuing operations', 
-                   'Net income from discontinuing ops', 'Other', 'Net income',
-                   'Net income available to common shareholders', 'Basic',
-                   'Diluted', 'EBITDA']
-    #For row in Morningstar csv, if row[0] is in our list add the row.
-    #Otherwise add an empty row.
-    self.financial_data = []
-    raw_financial_data = [row for row in financial_reader]
-    rfd_header = [h[0] for h in raw_financial_data]            
-    ttm_count = 0
-    for d in header_list:                
-        for i in raw_financial_data:
-            #Handle corner case of first row.
-            try:
-                if i[1] == 'TTM' and ttm_count == 0:
-                    self.financial_data.append(i)
-                    ttm_count = 1
-                    continue
-            #Skip appending Morningstar categories ie: 'Costs and expenses'.
-            except:
-                continue   
-            #Append our data and placeholder rows
-            if i[0] == d:
-                self.financial_data.append(i)
-            elif d not in rfd_header:
-                rfd_header.append(d)
-                self.financial_data.append(['No Data', 'N/A', 'N/A', 'N/A',
-                                            'N/A', 'N/A','N/A'])
-    #Append day for ISO standard dates.
-    for idx in range (2, 7):
-        self.financial_data[0][idx] += '-01' 
+    #Index the Morningstar csv rows by label in one pass.
+    header = None
+    rows_by_label = {}
+    for row in financial_reader:
+        #Skip Morningstar categories ie: 'Costs and expenses'.
+        if len(row) < 2:
+            continue
+        #The first row with TTM holds the column dates.
+        if header is None and row[1] == 'TTM':
+            header = row
+            continue
+        rows_by_label.setdefault(row[0], []).append(row)
+    #Add our rows in datacode order. Rows Morningstar does not have
+    #get placeholders.
+    financial_data = [header]
+    for name, label, occurrence in FINANCIAL_ROWS:
+        rows = rows_by_label.get(label, [])
+        if occurrence < len(rows):
+            financial_data.append(rows[occurrence])
+        else:
+            financial_data.append(['No Data', 'N/A', 'N/A', 'N/A',
+                                   'N/A', 'N/A','N/A'])
+    if header is None:
+        financial_data[0] = ['No Data', 'TTM', 'N/A', 'N/A', 'N/A', 'N/A', 'N/A']
+    else:
+        #Append day for ISO standard dates.
+        for idx in range (2, 7):
+            financial_data[0][idx] += '-01' 
+    return financial_data
 
 def financial_datacode_map():
     """Create a dictionary mapping datacodes to (row, col) in data."""
@@ -185,3 +224,77 @@ def financial_datacode_map():
         row, col = divmod(idx - 1, 6)
         return row, col + 1
     return {idx: mapping(idx) for idx in range(1, 163)}
+
+def datacode_name(datacode):
+    """Return the name for a named datacode, or None for a numeric one"""
+    try:
+        float(datacode)
+        return None
+    except (TypeError, ValueError):
+        return str(datacode).strip()
+
+def label_index(data):
+    """Map lower case row labels to the first row with that label"""
+    index = {}
+    for row, values in enumerate(data[1:], 1):
+        if values:
+            index.setdefault(values[0].strip().lower(), row)
+    return index
+
+def resolve_name(name, row_index, header):
+    """Resolve 'Label:Column' to (row, col). The column is TTM or a
+    date from the header row, e.g. 2016-12. Without a column TTM is used.
+    Returns (None, None) for unknown names."""
+    label, sep, column = name.rpartition(':')
+    if not sep:
+        label, column = name, 'TTM'
+    row = row_index.get(label.strip().lower())
+    column = column.strip().upper()
+    for col in range(1, len(header)):
+        heading = header[col].upper()
+        # Key ratio headers have '-01' appended, TTM included
+        if heading in (column, column + '-01') or heading[:7] == column:
+            if row is not None:
+                return row, col
+    return None, None
+
+#Rows of the financials in datacode order as (name, Morningstar label,
+#occurrence). Basic and Diluted appear twice, for earnings per share
+#and for weighted average shares outstanding.
+FINANCIAL_ROWS = [('Revenue', 'Revenue', 0),
+                  ('Cost of revenue', 'Cost of revenue', 0),
+                  ('Gross profit', 'Gross profit', 0),
+                  ('Research and development', 'Research and development', 0),
+                  ('Sales, General and administrative',
+                   'Sales, General and administrative', 0),
+                  ('Depreciation and amortization',
+                   'Depreciation and amortization', 0),
+                  ('Interest expense', 'Interest expense', 0),
+                  ('Other operating expenses', 'Other operating expenses', 0),
+                  ('Total costs and expenses', 'Total costs and expenses', 0),
+                  ('Total operating expenses', 'Total operating expenses', 0),
+                  ('Operating income', 'Operating income', 0),
+                  ('Interest Expense (non-operating)', 'Interest Expense', 0),
+                  ('Other income (expense)', 'Other income (expense)', 0),
+                  ('Income before taxes', 'Income before taxes', 0),
+                  ('Income before income taxes', 'Income before income taxes', 0),
+                  ('Provision for income taxes', 'Provision for income taxes', 0),
+                  ('Net income from continuing operations',
+                   'Net income from continuing operations', 0),
+                  ('Net income from discontinuing ops',
+                   'Net income from discontinuing ops', 0),
+                  ('Other', 'Other', 0),
+                  ('Net income', 'Net income', 0),
+                  ('Net income available to common shareholders',
+                   'Net income available to common shareholders', 0),
+                  ('EPS Basic', 'Basic', 0),
+                  ('Shares Basic', 'Basic', 1),
+                  ('EPS Diluted', 'Diluted', 0),
+                  ('Shares Diluted', 'Diluted', 1),
+                  ('EBITDA', 'EBITDA', 0)]
+
+#Precomputed lookup tables shared by all SmfImpl instances.
+FINANCIAL_ROW_INDEX = {name.lower(): row for row, (name, label, occurrence)
+                       in enumerate(FINANCIAL_ROWS, 1)}
+FINANCIAL_DATACODES = financial_datacode_map()
+KEYRATIO_DATACODES = keyratio_datacode_map()
@@ -0,0 +1,95 @@
+#  single_flight.py - Coalesce concurrent identical provider requests for the SMF Extension.
+#
+#  license: GNU LGPL
+#
+#  This library is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  NOTE
+#  When a sheet opens, many cells for the same ticker can be evaluated
+#  before the first provider request completes. SingleFlight makes sure
+#  only one request per (provider, ticker, resource) key is in flight.
+#  Every other caller with the same key waits for that request and gets
+#  the same result, or the same exception.
+#
+
+import threading
+
+
+class _Call:
+    """
+    An in-flight request and its outcome
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Request coalescing keyed by (provider, ticker, resource)
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, fn, *args):
+        """
+        Call fn(*args) unless a call with the same key is already in flight,
+        in which case wait for that call and share its outcome.
+        :param key: Hashable request key, e.g. ("yahoo", ticker, stat)
+        :param fn: Function that performs the request
+        :param args: Arguments for fn
+        :return: The result of fn. If fn raised, the same exception is raised to every caller.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.coalesced += 1
+                leader = False
+            else:
+                call = _Call()
+                self.calls[key] = call
+                self.executed += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args)
+        except BaseException as ex:
+            call.error = ex
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def statistics(self):
+        """
+        :return: Dict of request counters
+        """
+        with self.lock:
+            return {
+                "in_flight": len(self.calls),
+                "executed": self.executed,
+                "coalesced": self.coalesced,
+            }
+
+
+# Shared by all providers
+provider_flight = SingleFlight()
@@ -12,14 +12,6 @@
 import os
 import sys
 import inspect
-import csv
-#Try/except is for LibreOffice Python3.x vs. OpenOffice Python2.x.
-try:
-    from urllib.request import Request, urlopen
-    from urllib.error import URLError
-except ImportError:
-    from urllib2 import Request, urlopen, URLError
-from codecs import iterdecode
 import unohelper
 from com.smf.ticker.getinfo import XSmf
 # Add current directory to path to import yahoo, morningstar and advfn modules
@@ -34,40 +26,77 @@ import morningstar
 import advfn
 import yahoo_hist
 import html_hist_quote
+import async_fetch
+import deadline
+import exchange_index
+import smf_cache
+from smf_config import SMFConfiguration
 
 class SmfImpl(unohelper.Base, XSmf ):
     """Define the main class for the SMF extension """    
     def __init__( self, ctx ):
         self.ctx = ctx
-        self.nyse_list = []
-        self.nasdaq_list = []
-        self.amex_list = []
-        self.exchange_flag = ['0', '0', '0']
-        self.yahoo_flag = ['0', '']
-        self.keyratio_flag = ['0', '']
-        self.financial_flag = ['0', '']
-        self.qfinancial_flag = ['0', '']
-        #Setup for url calls to ADVFN in 5 chunks, most recent year first.
-        self.advfn_start_list = [21, 16, 11, 6, 1]
-        #start_list idx, year_count, total_year_count, ticker, Error, have data.
-        self.advfn_flag = [0, 0, 0, '', None, False]
-        self.advfn_data = []
-        self.old_advfn_data = []
-        self.total_advfn_data = []
-        self.yahoo_hist_cache = {}
+        #Downloaded data for recently used tickers, one store per data set.
+        self.yahoo_store = self.__new_store("yahoo")
+        self.keyratio_store = self.__new_store("morningstar")
+        self.financial_store = self.__new_store("morningstar")
+        self.qfinancial_store = self.__new_store("morningstar")
+        self.advfn_store = self.__new_store("advfn")
+
+    def __new_store(self, provider):
+        """Create a bounded ticker -> data store. Data is kept for the provider's ttl."""
+        return smf_cache.LRUCache(
+            int(SMFConfiguration.get("ticker_store_entries")),
+            int(SMFConfiguration.get("ticker_store_bytes")),
+            ttl=float(SMFConfiguration.get(provider + "_ttl")))
+
+    def get_store_statistics(self):
+        """Return hit rate and resident size of each ticker store"""
+        return {"yahoo": self.yahoo_store.statistics(),
+                "keyratios": self.keyratio_store.statistics(),
+                "financials": self.financial_store.statistics(),
+                "qfinancials": self.qfinancial_store.statistics(),
+                "advfn": self.advfn_store.statistics()}
+
     #Following functions are called and mapped by LO through the Xsmf.rdb file.
+    @deadline.recalc_call
     def getIntrinioQuote( self, ticker, tgtdate ):
         try:
-            x = html_hist_quote.intrinio_fetch_data(self, ticker, tgtdate)
+            # The login dialog must run on the Calc thread, so Intrinio is
+            # only fetched in the background once it is configured.
+            if html_hist_quote.QConfiguration.is_configured():
+                x = async_fetch.dispatch(('getIntrinioQuote', ticker, tgtdate),
+                    lambda: html_hist_quote.lookup_cached(ticker, tgtdate),
+                    lambda: html_hist_quote.intrinio_fetch_data(self, ticker, tgtdate))
+            else:
+                x = html_hist_quote.intrinio_fetch_data(self, ticker, tgtdate)
         except Exception as ex:
             x = str(ex)
         return x
+    @deadline.recalc_call
     def getHistoricalQuote( self, ticker, tgtdate ):
         try:
-            x = html_hist_quote.fetch_data(self, ticker, tgtdate)
+            x = async_fetch.dispatch(('getHistoricalQuote', ticker, tgtdate),
+                lambda: html_hist_quote.lookup_cached(ticker, tgtdate),
+                lambda: html_hist_quote.fetch_data(self, ticker, tgtdate))
         except Exception as ex:
             x = str(ex)
         return x
+    @deadline.recalc_call
+    def getHistoricalSeries( self, ticker, startdate, enddate, fields ):
+        try:
+            x = html_hist_quote.fetch_series(self, ticker, startdate, enddate, fields)
+        except Exception as ex:
+            x = ((str(ex),),)
+        return x
+    @deadline.recalc_call
+    def getIntrinioRange( self, tickers, startdate, enddate ):
+        try:
+            x = html_hist_quote.load_intrinio_range(self, tickers, startdate, enddate)
+        except Exception as ex:
+            x = ((str(ex),),)
+        return x
+    @deadline.recalc_call
     def getYahooHist( self, ticker, tgtdate, datacode ):
         try:
             x = yahoo_hist.fetch_data(self, ticker, tgtdate, datacode)
@@ -75,13 +104,26 @@ class SmfImpl(unohelper.Base, XSmf ):
             x = str(ex)
         return x
 
+    @deadline.recalc_call
     def getYahoo( self, ticker, datacode ):
         # Retrieve the requested data
         try:
-            s = yahoo.fetch_data(self, ticker, datacode)
+            if async_fetch.is_enabled():
+                s = yahoo.lookup_cached(self, ticker, datacode)
+                if s is None:
+                    # Cells evaluated during the batch window share one download
+                    request = yahoo.batcher.request(ticker)
+                    return async_fetch.fetcher.submit(('getYahoo', ticker, datacode),
+                        lambda: self.__yahoo_value(yahoo.fetch_data(self, ticker, datacode, request)),
+                        request)
+            else:
+                s = yahoo.fetch_data(self, ticker, datacode)
         except Exception as ex:
             # x = yahoo.fetch_data(self, ticker, datacode)
             return str(ex)
+        return self.__yahoo_value(s)
+
+    def __yahoo_value(self, s):
         # If the data was retrieved, if possible, convert it to float
         try:
             x = float(s)
@@ -89,6 +131,7 @@ class SmfImpl(unohelper.Base, XSmf ):
             x = s
         return x
 
+    @deadline.recalc_call
     def getMorningKey( self, ticker, datacode):
         try:
             s = morningstar.fetch_keyratios(self, ticker, datacode)
@@ -100,6 +143,7 @@ class SmfImpl(unohelper.Base, XSmf ):
             x = s
         return x
     
+    @deadline.recalc_call
     def getMorningFin( self, ticker, datacode):
         fin_type = ''
         try:
@@ -112,6 +156,7 @@ class SmfImpl(unohelper.Base, XSmf ):
             x = s
         return x
     
+    @deadline.recalc_call
     def getMorningQFin( self, ticker, datacode):
         fin_type = 'qtr'
         try:
@@ -125,68 +170,22 @@ class SmfImpl(unohelper.Base, XSmf ):
         return x
 
 
+    @deadline.recalc_call
     def getADVFN(self, ticker, datacode):
         """Return ADVFN data. Mapped to PyUNO through the Xsmf.rdb file"""
         try:
-            x = float(advfn.fetch_advfn(self, ticker, datacode))
+            s = advfn.fetch_advfn(self, ticker, datacode)
+        except Exception as ex:
+            return str(ex)
+        try:
+            x = float(s)
         except:
-            x = advfn.fetch_advfn(self, ticker, datacode)
+            x = s
         return x
 
 def find_exchange(self, ticker):
     """Determine exchange ticker is traded on for querying data providers"""
-    exch_name = ['nasdaq','nyse','amex']
-    #Get exchange lists we don't have already, and return ticker's exchange.
-    for exch in exch_name:
-        if exch == 'nasdaq':
-            if self.exchange_flag[0] == '0':
-                    query_nasdaq(self, exch)
-                    self.exchange_flag[0] = '1'
-            for i in self.nasdaq_list:
-                if ticker == i[0]:
-                    return 'XNAS'
-        if exch == 'nyse':
-            if self.exchange_flag[1] == '0':
-                    query_nasdaq(self, exch)
-                    self.exchange_flag[1] = '1'
-            for i in self.nyse_list:
-                if ticker == i[0]:
-                    return 'XNYS'
-        if exch == 'amex':
-            if self.exchange_flag[2] == '0':
-                    query_nasdaq(self, exch)
-                    self.exchange_flag[2] = '1'
-            for i in self.amex_list:
-                if ticker == i[0]:
-                    return 'XASE'
-    return 'Exchange lookup failed. Only NYSE, NASDAQ, and AMEX are supported.'
-
-def query_nasdaq(self, exch_name):
-    """Query Nasdaq for list of tickers by exchange"""
-    header = {'user-agent': 'Mozilla/5.0 '\
-              '(Macintosh; Intel Mac OS X 10.9; rv:32.0)'\
-              ' Gecko/20100101 Firefox/32.0',}
-    url = 'http://www.nasdaq.com/screening/companies-by-name.aspx?letter=0'\
-          '&exchange=%s&render=download' % (exch_name)
-    req = Request(url, headers = header)
-    try:
-        response = urlopen(req)
-    #Catch errors.
-    except URLError as e:
-        self.exchange_flag[0] = '1'
-        if hasattr(e, 'reason'):
-            return e.reason
-        elif hasattr(e,'code'):
-            return 'Error', e.code
-    #Setup list(s) of exchange names.
-    exch_result = csv.reader(iterdecode(response,'utf-8'))
-    if exch_name == 'nasdaq':
-        self.nasdaq_list = [row for row in exch_result]
-    elif exch_name == 'nyse':
-        self.nyse_list = [row for row in exch_result]
-    elif exch_name == 'amex':
-        self.amex_list = [row for row in exch_result]
-    return 'Unknown Exception in query_nasdaq'
+    return exchange_index.find_exchange(ticker)
 
 
 def createInstance( ctx ):
@@ -0,0 +1,693 @@
+#  smf_cache.py - Shared historical quote cache for the SMF Extension.
+#
+#  license: GNU LGPL
+#
+#  This library is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  NOTE
+#  This module owns the historical quote cache DB (smf_yh_cache.sqlite3).
+#  All providers read and write SymbolDate through the functions at the
+#  bottom of this file. Nothing else should open the DB file.
+#
+#  One connection is kept open for the life of the process and access to
+#  it is serialized, so the cost of opening the file is paid once instead
+#  of once per cell. The schema version is kept in PRAGMA user_version and
+#  any pending migrations in SCHEMA_MIGRATIONS are applied when the
+#  connection is opened.
+#
+#  The DB also holds the parsed snapshot data downloaded from Yahoo,
+#  Morningstar and ADVFN, keyed by provider, ticker and dataset, so that
+#  it survives a LibreOffice restart. Each snapshot expires after a
+#  provider specific time to live.
+#
+#  Raw provider responses that carry ETag/Last-Modified validators are
+#  kept zlib compressed in the Response table, so http_client can
+#  revalidate them with a conditional GET. The table is bounded by size
+#  and entries that have not been used for a while are evicted.
+#
+#  In front of the DB sits a bounded in memory LRU of recently used
+#  records and a negative cache that remembers, for a limited time, the
+#  ticker/date pairs a provider had no data for.
+#
+
+import os
+import os.path
+import sqlite3
+import json
+import zlib
+import sys
+import time
+import threading
+import atexit
+from collections import OrderedDict
+from app_logger import AppLogger
+from smf_config import get_smf_dir, SMFConfiguration
+
+# Logger init
+app_logger = AppLogger("smf-extension")
+logger = app_logger.getAppLogger()
+
+# SQL used against the cache DB. sqlite3 keeps compiled statements in a per
+# connection cache keyed by the statement text, so always using these exact
+# strings means each statement is prepared only once per process.
+CREATE_SYMBOLDATE_SQL = "CREATE TABLE IF NOT EXISTS SymbolDate (Symbol text not null, Date text not null, " \
+                        "Open real, High real, Low real, Close real, Volume integer, Adj_Close real, " \
+                        "PRIMARY KEY(Symbol,Date))"
+LOOKUP_SYMBOL_DATE_SQL = "SELECT * from SymbolDate where Symbol=? and Date=?"
+LOOKUP_SYMBOL_RANGE_SQL = "SELECT * from SymbolDate where Symbol=? and Date>=? and Date<=? order by Date"
+LOOKUP_SYMBOLS_DATE_SQL = "SELECT * from SymbolDate where Date=? and Symbol in ({0})"
+# Symbols per LOOKUP_SYMBOLS_DATE_SQL query. Older SQLite builds allow 999 bound variables.
+LOOKUP_SYMBOLS_CHUNK = 900
+# Used for prefetched rows, some of which may already be cached
+INSERT_OR_IGNORE_SYMBOL_DATE_SQL = "INSERT OR IGNORE INTO SymbolDate values (?,?,?,?,?,?,?,?)"
+UPSERT_SYMBOL_DATE_SQL = "INSERT OR REPLACE INTO SymbolDate values (?,?,?,?,?,?,?,?)"
+LOOKUP_SNAPSHOT_SQL = "SELECT * from Snapshot where Provider=? and Ticker=? and Dataset=? and Expires>?"
+UPSERT_SNAPSHOT_SQL = "INSERT OR REPLACE INTO Snapshot values (?,?,?,?,?,?)"
+LOOKUP_RESPONSE_SQL = "SELECT * from Response where Url=?"
+UPSERT_RESPONSE_SQL = "INSERT OR REPLACE INTO Response values (?,?,?,?,?,?,?,?)"
+TOUCH_RESPONSE_SQL = "UPDATE Response set LastUsed=? where Url=?"
+EXPIRE_RESPONSES_SQL = "DELETE FROM Response where LastUsed<?"
+RESPONSE_SIZE_SQL = "SELECT count(*) as Responses, coalesce(sum(Size), 0) as Response_Bytes from Response"
+OLDEST_RESPONSES_SQL = "SELECT Url, Size from Response order by LastUsed"
+DELETE_RESPONSE_SQL = "DELETE FROM Response where Url=?"
+STATISTICS_SQL = "SELECT count(*) as Rows, count(distinct Symbol) as Symbols, " \
+                 "min(Date) as First_Date, max(Date) as Last_Date from SymbolDate"
+
+# Schema migrations. Entry n holds the statements that take the schema from
+# version n to version n + 1. Only ever append to this list.
+SCHEMA_MIGRATIONS = [
+    # 1: The original SymbolDate table. DBs created before versioning
+    # already have it and report version 0.
+    [CREATE_SYMBOLDATE_SQL],
+    # 2: Date index for multi-symbol lookups
+    ["CREATE INDEX IF NOT EXISTS SymbolDate_Date ON SymbolDate (Date)"],
+    # 3: Snapshot data from Yahoo, Morningstar and ADVFN as JSON
+    ["CREATE TABLE IF NOT EXISTS Snapshot (Provider text not null, Ticker text not null, "
+     "Dataset text not null, Fetched real, Expires real, Data text, "
+     "PRIMARY KEY(Provider,Ticker,Dataset))"],
+    # 4: Compressed raw responses with their validators
+    ["CREATE TABLE IF NOT EXISTS Response (Url text not null PRIMARY KEY, ETag text, "
+     "LastModified text, ContentType text, Fetched real, LastUsed real, Size integer, Body blob)",
+     "CREATE INDEX IF NOT EXISTS Response_LastUsed ON Response (LastUsed)"],
+]
+SCHEMA_VERSION = len(SCHEMA_MIGRATIONS)
+
+# Connection tuning. WAL lets readers in other LO processes proceed while
+# a quote is being written and NORMAL sync is safe under WAL.
+CACHE_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-4096",
+    "PRAGMA mmap_size=33554432",
+]
+
+
+def get_cache_file_path():
+    """
+    Return the full path to the cache DB. The location is OS dependent.
+    :return: Full path to smf_yh_cache.sqlite3
+    """
+    return get_smf_dir() + "smf_yh_cache.sqlite3"
+
+
+class CacheConnection:
+    """
+    Process wide connection to the historical quote cache DB.
+    The connection is opened on first use and shared by every caller.
+    All access goes through the class lock because a single sqlite3
+    connection must not be used by two threads at the same time.
+    """
+    lock = threading.RLock()
+    conn = None
+    full_file_path = ""
+    schema_version = 0
+    reads = 0
+    writes = 0
+
+    @classmethod
+    def get(cls):
+        """
+        Return the shared connection, opening it if necessary.
+        The caller must hold CacheConnection.lock while using it.
+        :return: Database connection.
+        """
+        with cls.lock:
+            if cls.conn is None:
+                cls.conn = cls.__open()
+            return cls.conn
+
+    @classmethod
+    def __open(cls):
+        cls.full_file_path = get_cache_file_path()
+        conn = sqlite3.connect(cls.full_file_path, timeout=5.0, check_same_thread=False,
+                               cached_statements=32)
+        for pragma in CACHE_PRAGMAS:
+            try:
+                conn.execute(pragma)
+            except sqlite3.Error as ex:
+                # Some embedded sqlite3 builds do not support every pragma
+                logger.debug("%s failed: %s", pragma, str(ex))
+        cls.schema_version = cls.__migrate(conn)
+
+        # We use the row factory to get named row columns. Makes handling row sets easier.
+        conn.row_factory = sqlite3.Row
+        # The default string type is unicode. This changes it to UTF-8.
+        conn.text_factory = str
+        logger.debug("Opened cache DB %s", cls.full_file_path)
+        return conn
+
+    @classmethod
+    def __migrate(cls, conn):
+        """
+        Bring the DB schema up to SCHEMA_VERSION. The migration runs in an
+        immediate transaction so only one LO process migrates a shared DB.
+        :param conn: Open connection
+        :return: The schema version
+        """
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            if version > SCHEMA_VERSION:
+                logger.warning("Cache DB schema version %d is newer than %d", version, SCHEMA_VERSION)
+            return version
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Another process may have migrated while we waited for the lock
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for v in range(version, SCHEMA_VERSION):
+                logger.info("Migrating cache DB schema to version %d", v + 1)
+                for sql in SCHEMA_MIGRATIONS[v]:
+                    conn.execute(sql)
+            conn.execute("PRAGMA user_version={0}".format(max(version, SCHEMA_VERSION)))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return max(version, SCHEMA_VERSION)
+
+    @classmethod
+    def fetchone(cls, sql, params):
+        """
+        Run a query against the cache DB and return the first row.
+        :param sql: One of the module level SQL statements.
+        :param params: Statement parameters.
+        :return: The first row or None if there are no rows.
+        """
+        with cls.lock:
+            cls.reads += 1
+            return cls.get().execute(sql, params).fetchone()
+
+    @classmethod
+    def fetchall(cls, sql, params):
+        """
+        Run a query against the cache DB and return all rows.
+        :param sql: One of the module level SQL statements.
+        :param params: Statement parameters.
+        :return: List of rows.
+        """
+        with cls.lock:
+            cls.reads += 1
+            return cls.get().execute(sql, params).fetchall()
+
+    @classmethod
+    def execute_commit(cls, sql, params):
+        """
+        Run a modifying statement against the cache DB and commit it.
+        :param sql: One of the module level SQL statements.
+        :param params: Statement parameters.
+        :return: None
+        """
+        with cls.lock:
+            conn = cls.get()
+            cls.writes += 1
+            try:
+                conn.execute(sql, params)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    @classmethod
+    def executemany_commit(cls, sql, param_list):
+        """
+        Run a modifying statement once for each parameter set in a single transaction.
+        :param sql: One of the module level SQL statements.
+        :param param_list: List of statement parameter sets.
+        :return: None
+        """
+        with cls.lock:
+            conn = cls.get()
+            cls.writes += 1
+            try:
+                conn.executemany(sql, param_list)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    @classmethod
+    def close(cls):
+        """
+        Close the shared connection. It will be reopened on next use.
+        :return: None
+        """
+        with cls.lock:
+            if cls.conn is not None:
+                cls.conn.close()
+                cls.conn = None
+
+
+# Make sure the WAL is checkpointed when LO shuts down the Python runtime
+atexit.register(CacheConnection.close)
+
+
+def estimate_size(value):
+    """
+    Rough estimate of the memory held by a cached value
+    :param value: A scalar, list, tuple, dict or an object holding those in
+    its attributes. Containers are measured recursively.
+    :return: Size in bytes
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += sys.getsizeof(k) + estimate_size(v)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            size += estimate_size(v)
+    elif hasattr(value, "__dict__"):
+        size += estimate_size(vars(value))
+    return size
+
+
+class LRUCache:
+    """
+    Thread safe, bounded, least recently used cache.
+    The cache is bounded both by entry count and by the estimated
+    size of the cached values. With a ttl, values older than ttl
+    seconds are treated as not cached.
+    """
+    def __init__(self, max_entries, max_bytes, sizeof=estimate_size, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # key -> (value, size, time stored)
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """
+        Return the cached value for key and mark it most recently used
+        :param key:
+        :return: The cached value or None if key is not cached or has expired
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[2] > self.ttl:
+                del self.entries[key]
+                self.bytes -= entry[1]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """
+        Add or replace a cached value, evicting least recently used values as needed
+        :param key:
+        :param value:
+        :return: None
+        """
+        size = self.sizeof(key) + self.sizeof(value)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            # A value larger than the whole budget is not cached at all
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (value, size, time.time())
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                k, (v, sz, stored) = self.entries.popitem(last=False)
+                self.bytes -= sz
+                self.evictions += 1
+
+    def remove(self, key):
+        """
+        Remove a cached value if it exists
+        :param key:
+        :return: None
+        """
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def statistics(self):
+        """
+        :return: Dict of cache counters
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+            }
+
+
+class NegativeCache:
+    """
+    Thread safe cache of "no data" answers. Each answer is remembered for
+    ttl seconds so a failing provider call is not repeated on every recalc.
+    """
+    def __init__(self, ttl, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # key -> (expiration time, message)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """
+        :param key:
+        :return: The remembered message or None if there is no unexpired answer for key
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self.hits += 1
+                    return entry[1]
+                del self.entries[key]
+                self.expirations += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, message):
+        """
+        Remember a "no data" answer
+        :param key:
+        :param message: What to report while the answer is remembered
+        :return: None
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, message)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def remove(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def statistics(self):
+        """
+        :return: Dict of cache counters
+        """
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expirations": self.expirations,
+            }
+
+
+# In memory caches in front of the SymbolDate table. Keys are (symbol, ISO date).
+memory_cache = LRUCache(int(SMFConfiguration.get("memory_cache_entries")),
+                        int(SMFConfiguration.get("memory_cache_bytes")))
+negative_cache = NegativeCache(float(SMFConfiguration.get("negative_cache_ttl")))
+
+
+def lookup_symbol_date(symbol, tgtdate):
+    """
+    Look up a historical quote record, first in memory then in the cache DB.
+    :param symbol:
+    :param tgtdate: ISO format date
+    :return: The record as a dict or None if it is not cached.
+    """
+    key = (symbol, tgtdate)
+    r = memory_cache.get(key)
+    if r is None:
+        r = CacheConnection.fetchone(LOOKUP_SYMBOL_DATE_SQL, [symbol, tgtdate])
+        if r is not None:
+            r = dict(r)
+            memory_cache.put(key, r)
+    return r
+
+
+def lookup_symbol_range(symbol, start_date, end_date):
+    """
+    Look up all cached historical quote records for a symbol in a date range
+    with a single query against the cache DB.
+    :param symbol:
+    :param start_date: ISO format date
+    :param end_date: ISO format date
+    :return: List of records as dicts in date order.
+    """
+    return [dict(r) for r in CacheConnection.fetchall(LOOKUP_SYMBOL_RANGE_SQL, [symbol, start_date, end_date])]
+
+
+def lookup_symbols_date(symbols, tgtdate):
+    """
+    Look up the cached historical quote records for several symbols on one date
+    with one query per LOOKUP_SYMBOLS_CHUNK symbols against the cache DB.
+    :param symbols: List of symbols
+    :param tgtdate: ISO format date
+    :return: Dict of symbol -> record dict. Symbols that are not cached are left out.
+    """
+    symbols = list(symbols)
+    records = {}
+    for idx in range(0, len(symbols), LOOKUP_SYMBOLS_CHUNK):
+        chunk = symbols[idx:idx + LOOKUP_SYMBOLS_CHUNK]
+        sql = LOOKUP_SYMBOLS_DATE_SQL.format(",".join(["?"] * len(chunk)))
+        for r in CacheConnection.fetchall(sql, [tgtdate] + chunk):
+            records[r["Symbol"]] = dict(r)
+    return records
+
+
+def insert_quotes(rows):
+    """
+    Add historical quote records in a single transaction. Records that
+    are already cached are left unchanged.
+    :param rows: List of [Symbol, Date, Open, High, Low, Close, Volume, Adj_Close]
+    :return: None
+    """
+    __write_quotes(INSERT_OR_IGNORE_SYMBOL_DATE_SQL, rows)
+
+
+def upsert_quotes(rows):
+    """
+    Add or replace historical quote records in a single transaction.
+    :param rows: List of [Symbol, Date, Open, High, Low, Close, Volume, Adj_Close]
+    :return: None
+    """
+    __write_quotes(UPSERT_SYMBOL_DATE_SQL, rows)
+
+
+def __write_quotes(sql, rows):
+    if not rows:
+        return
+    CacheConnection.executemany_commit(sql, rows)
+    for r in rows:
+        forget_symbol_date(r[0], r[1])
+
+
+def load_snapshot(provider, ticker, dataset):
+    """
+    Load unexpired snapshot data from the cache DB
+    :param provider: e.g. yahoo, morningstar, advfn
+    :param ticker:
+    :param dataset: Provider specific dataset name, e.g. keyratios
+    :return: The saved data or None if there is no unexpired snapshot
+    """
+    r = CacheConnection.fetchone(LOOKUP_SNAPSHOT_SQL, [provider, ticker, dataset, time.time()])
+    if r is None:
+        return None
+    logger.debug("Snapshot cache hit for %s %s %s", provider, ticker, dataset)
+    return json.loads(r["Data"])
+
+
+def save_snapshot(provider, ticker, dataset, data):
+    """
+    Save snapshot data in the cache DB. The time to live comes from
+    the <provider>_ttl setting.
+    :param provider: e.g. yahoo, morningstar, advfn
+    :param ticker:
+    :param dataset: Provider specific dataset name, e.g. keyratios
+    :param data: JSON serializable data
+    :return: None
+    """
+    now = time.time()
+    ttl = float(SMFConfiguration.get(provider + "_ttl") or 0)
+    CacheConnection.execute_commit(UPSERT_SNAPSHOT_SQL,
+                                   [provider, ticker, dataset, now, now + ttl, json.dumps(data)])
+
+
+def save_snapshots(provider, dataset, items):
+    """
+    Save snapshot data for several tickers in a single transaction.
+    :param provider: e.g. yahoo, morningstar, advfn
+    :param dataset: Provider specific dataset name, e.g. quotes
+    :param items: Dict of ticker -> JSON serializable data
+    :return: None
+    """
+    now = time.time()
+    ttl = float(SMFConfiguration.get(provider + "_ttl") or 0)
+    CacheConnection.executemany_commit(UPSERT_SNAPSHOT_SQL,
+                                       [[provider, ticker, dataset, now, now + ttl, json.dumps(data)]
+                                        for ticker, data in items.items()])
+
+
+def invalidate_snapshots(provider=None, ticker=None, dataset=None):
+    """
+    Delete saved snapshots. Arguments that are None match everything,
+    so invalidate_snapshots() deletes all snapshots.
+    :param provider: e.g. yahoo, morningstar, advfn
+    :param ticker:
+    :param dataset: Provider specific dataset name
+    :return: None
+    """
+    where = []
+    params = []
+    for column, value in (("Provider", provider), ("Ticker", ticker), ("Dataset", dataset)):
+        if value is not None:
+            where.append(column + "=?")
+            params.append(value)
+    sql = "DELETE FROM Snapshot"
+    if where:
+        sql += " where " + " and ".join(where)
+    CacheConnection.execute_commit(sql, params)
+
+
+def load_response(url):
+    """
+    Load a saved raw response
+    :param url:
+    :return: Dict with ETag, LastModified, ContentType and the uncompressed Body, or None
+    """
+    r = CacheConnection.fetchone(LOOKUP_RESPONSE_SQL, [url])
+    if r is None:
+        return None
+    return {
+        "ETag": r["ETag"],
+        "LastModified": r["LastModified"],
+        "ContentType": r["ContentType"],
+        "Body": zlib.decompress(r["Body"]),
+    }
+
+
+def touch_response(url):
+    """
+    Mark a saved response as used, typically after the server confirmed
+    it is still current.
+    :param url:
+    :return: None
+    """
+    CacheConnection.execute_commit(TOUCH_RESPONSE_SQL, [time.time(), url])
+
+
+def save_response(url, etag, last_modified, content_type, body):
+    """
+    Save a raw response compressed. Responses unused for longer than
+    response_cache_ttl are evicted, then the least recently used ones
+    until the table fits in response_cache_bytes.
+    :param url:
+    :param etag: ETag header or None
+    :param last_modified: Last-Modified header or None
+    :param content_type: Content-Type header or None
+    :param body: Uncompressed response body (bytes)
+    :return: None
+    """
+    now = time.time()
+    data = zlib.compress(body, 6)
+    max_bytes = int(SMFConfiguration.get("response_cache_bytes"))
+    if len(data) > max_bytes:
+        return
+    with CacheConnection.lock:
+        CacheConnection.execute_commit(UPSERT_RESPONSE_SQL,
+                                       [url, etag, last_modified, content_type, now, now, len(data),
+                                        sqlite3.Binary(data)])
+        CacheConnection.execute_commit(EXPIRE_RESPONSES_SQL,
+                                       [now - float(SMFConfiguration.get("response_cache_ttl"))])
+        total = CacheConnection.fetchone(RESPONSE_SIZE_SQL, [])["Response_Bytes"]
+        if total <= max_bytes:
+            return
+        evict = []
+        for r in CacheConnection.fetchall(OLDEST_RESPONSES_SQL, []):
+            if total <= max_bytes:
+                break
+            evict.append([r["Url"]])
+            total -= r["Size"]
+        CacheConnection.executemany_commit(DELETE_RESPONSE_SQL, evict)
+
+
+def forget_symbol_date(symbol, tgtdate):
+    """
+    Drop a ticker/date pair from the in memory caches, typically
+    because it has just been written to the cache DB.
+    :param symbol:
+    :param tgtdate: ISO format date
+    :return: None
+    """
+    memory_cache.remove((symbol, tgtdate))
+    negative_cache.remove((symbol, tgtdate))
+
+
+def get_statistics():
+    """
+    Return the cache counters
+    :return: Dict with "memory", "negative" and "db" counter dicts
+    """
+    r = CacheConnection.fetchone(STATISTICS_SQL, [])
+    db = dict(r)
+    db.update(dict(CacheConnection.fetchone(RESPONSE_SIZE_SQL, [])))
+    db.update({
+        "file": CacheConnection.full_file_path,
+        "schema_version": CacheConnection.schema_version,
+        "reads": CacheConnection.reads,
+        "writes": CacheConnection.writes,
+    })
+    try:
+        db["file_bytes"] = os.path.getsize(CacheConnection.full_file_path)
+    except OSError:
+        db["file_bytes"] = 0
+    return {
+        "memory": memory_cache.statistics(),
+        "negative": negative_cache.statistics(),
+        "db": db,
+    }
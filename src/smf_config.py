@@ -0,0 +1,150 @@
+#  smf_config.py - Installation settings for the SMF Extension.
+#
+#  license: GNU LGPL
+#
+#  This library is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  NOTE
+#  Settings are read from smf.conf, a JSON formatted file that lives in the
+#  same folder as the quote cache. The file is optional. Any setting that is
+#  not present in the file takes its default value from SMFConfiguration.defaults.
+#  Example:
+#
+#  {
+#  "prefetch_window": 3,
+#  "prefetch_unit": "months"
+#  }
+#
+
+import os
+import os.path
+import json
+from app_logger import AppLogger
+
+# Logger init
+app_logger = AppLogger("smf-extension")
+logger = app_logger.getAppLogger()
+
+
+def get_smf_dir():
+    """
+    Return the folder that holds the SMF cache and settings files.
+    The location is OS dependent. The folder is created if it does not exist.
+    :return: Folder path including a trailing separator
+    """
+    if os.name == "posix":
+        # Linux or OS X
+        file_path = "{0}/libreoffice/smf/".format(os.environ["HOME"])
+    elif os.name == "nt":
+        # windows
+        file_path = "{0}\\libreoffice\\smf\\".format(os.environ["LOCALAPPDATA"])
+
+    # Make the folder
+    if not os.path.exists(file_path):
+        logger.debug("Creating SMF directory %s", file_path)
+        os.makedirs(file_path, exist_ok=True)
+
+    return file_path
+
+
+class SMFConfiguration:
+    """
+    Encapsulates the SMF installation settings.
+    """
+    defaults = {
+        # On a historical quote cache miss, also fetch this many units
+        # on either side of the requested date. 0 fetches only the requested date.
+        "prefetch_window": 1,
+        # Unit for prefetch_window: days or months
+        "prefetch_unit": "months",
+        # Limits for the in memory historical quote cache
+        "memory_cache_entries": 20000,
+        "memory_cache_bytes": 16 * 1024 * 1024,
+        # Seconds to remember that a provider had no data for a ticker/date
+        "negative_cache_ttl": 15 * 60,
+        # Fetch historical quotes in the background on a cache miss and
+        # update the cell when the data arrives
+        "async_mode": False,
+        "async_workers": 4,
+        "async_placeholder": "Fetching...",
+        # Seconds that downloaded snapshot data stays fresh in the cache DB
+        "yahoo_ttl": 5 * 60,
+        "morningstar_ttl": 3 * 24 * 60 * 60,
+        "advfn_ttl": 14 * 24 * 60 * 60,
+        # Seconds before the NASDAQ/NYSE/AMEX symbol lists are downloaded again
+        "exchange_index_ttl": 24 * 60 * 60,
+        # Limits for each provider's in memory store of downloaded ticker data
+        "ticker_store_entries": 100,
+        "ticker_store_bytes": 32 * 1024 * 1024,
+        # Seconds to collect GETYAHOO tickers before downloading them in one
+        # request, and the maximum number of symbols per request
+        "yahoo_batch_window": 0.1,
+        "yahoo_batch_size": 100,
+        # Limits for the saved raw Morningstar, ADVFN and NASDAQ responses
+        # used for conditional GET requests
+        "response_cache_bytes": 64 * 1024 * 1024,
+        "response_cache_ttl": 30 * 24 * 60 * 60,
+        # Consecutive failures that open a provider's circuit breaker, and the
+        # first and longest wait in seconds before a provider is tried again
+        "breaker_failure_threshold": 3,
+        "breaker_reset_timeout": 30,
+        "breaker_max_timeout": 10 * 60,
+        # Seconds to wait for a connection and for each read. Can be set per
+        # provider, e.g. "advfn_read_timeout".
+        "connect_timeout": 5,
+        "read_timeout": 20,
+        # Seconds of network time a recalculation may use, and the pause in
+        # add-in calls that starts a new recalculation. 0 switches the budget off.
+        "recalc_budget": 60,
+        "recalc_idle_gap": 2,
+        # Intrinio calls allowed per day, and the number of calls left at
+        # which each call starts fetching a wider date range
+        "intrinio_daily_limit": 500,
+        "intrinio_low_quota": 50,
+        # Historical quote providers tried on a cache miss, see hist_router.py
+        "hist_providers": ["google_csv", "google_html", "wsj", "intrinio"],
+        # What a historical quote request for a weekend or exchange holiday
+        # returns: previous (the prior session), error or exact (look it up as given)
+        "calendar_policy": "previous",
+    }
+    settings = {}
+    # Full path to the smf.conf file
+    full_file_path = ""
+
+    @classmethod
+    def load(cls):
+        """
+        Load settings from smf.conf. Missing or invalid files leave the defaults in effect.
+        :return:
+        """
+        cls.full_file_path = get_smf_dir() + "smf.conf"
+        cls.settings = dict(cls.defaults)
+        try:
+            cf = open(cls.full_file_path, "r")
+            cls.settings.update(json.loads(cf.read()))
+            cf.close()
+            logger.debug("smf.conf loaded")
+        except FileNotFoundError as ex:
+            logger.debug("%s was not found, using default settings", cls.full_file_path)
+        except Exception as ex:
+            logger.debug("An exception occurred while attempting to load smf.conf")
+            logger.debug(str(ex))
+
+        for key, value in sorted(cls.settings.items()):
+            logger.info("%s: %s", key, value)
+
+    @classmethod
+    def get(cls, key):
+        """
+        Return the value of a setting.
+        :param key: Setting name
+        :return: The configured value, or the default if it is not configured.
+        """
+        return cls.settings.get(key, cls.defaults.get(key))
+
+
+# Initialize SMF configuration
+SMFConfiguration.load()
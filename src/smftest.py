@@ -61,6 +61,8 @@ def main(argv):
     print ("Date used is", arg_date)
     if arg_funct == "morningkey":
         key_test(main_smf, arg_ticker)
+    elif arg_funct == "morningname":
+        name_test(main_smf, arg_ticker)
     elif arg_funct == "morningfin":
         fin_test(main_smf, arg_ticker, '')
     elif arg_funct == "morningqfin":
@@ -71,6 +73,8 @@ def main(argv):
         advfn_test(main_smf, arg_ticker)
     elif arg_funct == "yahoohist":
         yahoohist_test(main_smf, arg_ticker, arg_date)
+    elif arg_funct == "intriniorange":
+        intriniorange_test(main_smf, arg_ticker, arg_date)
     sys.exit(2)
 
 def key_test(smf_py, ticker):
@@ -83,6 +87,14 @@ def key_test(smf_py, ticker):
         print (datacode,': ', smf_py.getMorningKey(ticker, datacode))
     sys.exit()
 
+def name_test(smf_py, ticker):
+    # The key ratio header has '-01' appended to every column, TTM included
+    names = ["Revenue USD Mil", "Revenue USD Mil:TTM", "Revenue USD Mil:ttm",
+             "Net Income USD Mil:TTM"]
+    for name in names:
+        print (name,': ', smf_py.getMorningKey(ticker, name))
+    sys.exit()
+
 def fin_test(smf_py, ticker, fin_type):
     test_data = []
     func_call = smf_py.getMorningFin
@@ -123,10 +135,20 @@ def yahoohist_test(smf_py, ticker, tgtdate):
         print (datacode,': ', smf_py.getYahooHist(ticker, tgtdate, datacode))
     sys.exit()
 
+def intriniorange_test(smf_py, tickers, startdate):
+    # Load from startdate to today, then read a few dates back from the cache
+    import datetime
+    enddate = datetime.date.today().strftime("%Y-%m-%d")
+    for row in smf_py.getIntrinioRange(tickers, startdate, enddate):
+        print (row)
+    for ticker in tickers.split(','):
+        print (ticker, startdate,': ', smf_py.getIntrinioQuote(ticker, startdate))
+    sys.exit()
+
 def usage(err):
     print ("Usage: smftest.py -f <function> -t <ticker> -d <yyyy-mm-dd>")
-    print ('Available functions are morningkey, morningfin, morningqfin, yahoo, yahoohist'
-           'and advfn')
+    print ('Available functions are morningkey, morningname, morningfin, morningqfin, yahoo, yahoohist, '
+           'intriniorange and advfn')
     if err == 2:
         sys.exit(2)
     else:
@@ -0,0 +1,154 @@
+#  trading_calendar.py - NYSE/NASDAQ trading calendar for the SMF Extension.
+#
+#  license: GNU LGPL
+#
+#  This library is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  NOTE
+#  Sheets often ask for quotes on month or quarter ends that fall on a
+#  weekend or holiday. No provider has a quote for those dates, so every
+#  recalc would call the network again. Dates are checked against the
+#  NYSE/NASDAQ calendar before the cache is searched. What happens to a
+#  date without a trading session depends on the calendar_policy setting:
+#
+#  * previous - use the closest earlier session (default). The date shares
+#    the cache entry of that session.
+#  * error - report that the date is not a trading day.
+#  * exact - look the date up as given.
+#
+#  Holidays are computed from the exchange rules: New Year's Day, Martin
+#  Luther King Jr. Day (from 1998), Washington's Birthday, Good Friday,
+#  Memorial Day, Juneteenth (from 2022), Independence Day, Labor Day,
+#  Thanksgiving and Christmas. A holiday on a Saturday is observed on the
+#  Friday before, except New Year's Day. A holiday on a Sunday is observed
+#  on the Monday after. Unscheduled closures are listed in SPECIAL_CLOSURES.
+#
+
+import datetime
+from functools import lru_cache
+from smf_config import SMFConfiguration
+
+# Days the markets were closed outside the regular holiday rules
+SPECIAL_CLOSURES = frozenset(datetime.date(*d) for d in [
+    (1994, 4, 27),      # President Nixon's funeral
+    (2001, 9, 11), (2001, 9, 12), (2001, 9, 13), (2001, 9, 14),     # September 11
+    (2004, 6, 11),      # President Reagan's funeral
+    (2007, 1, 2),       # President Ford's funeral
+    (2012, 10, 29), (2012, 10, 30),     # Hurricane Sandy
+    (2018, 12, 5),      # President G.H.W. Bush's funeral
+    (2025, 1, 9),       # President Carter's funeral
+])
+
+POLICIES = ("previous", "error", "exact")
+
+
+def easter(year):
+    """
+    Western Easter Sunday (anonymous Gregorian algorithm)
+    :param year:
+    :return: datetime.date
+    """
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return datetime.date(year, month, day + 1)
+
+
+def nth_weekday(year, month, weekday, n):
+    """
+    :param weekday: 0 = Monday
+    :param n: 1 for the first, -1 for the last
+    :return: datetime.date of the nth weekday of the month
+    """
+    if n > 0:
+        d = datetime.date(year, month, 1)
+        d += datetime.timedelta(days=(weekday - d.weekday()) % 7)
+        return d + datetime.timedelta(weeks=n - 1)
+    next_month = datetime.date(year + month // 12, month % 12 + 1, 1)
+    d = next_month - datetime.timedelta(days=1)
+    return d - datetime.timedelta(days=(d.weekday() - weekday) % 7)
+
+
+def observed(d):
+    """
+    :return: The weekday a fixed date holiday is observed on
+    """
+    if d.weekday() == 5:
+        return d - datetime.timedelta(days=1)
+    if d.weekday() == 6:
+        return d + datetime.timedelta(days=1)
+    return d
+
+
+@lru_cache(maxsize=64)
+def holidays(year):
+    """
+    :param year:
+    :return: frozenset of the dates the exchanges are closed for a holiday in year
+    """
+    days = set()
+    new_year = datetime.date(year, 1, 1)
+    # New Year's Day on a Saturday is not observed on the Friday before
+    if new_year.weekday() != 5:
+        days.add(observed(new_year))
+    if year >= 1998:
+        days.add(nth_weekday(year, 1, 0, 3))
+    days.add(nth_weekday(year, 2, 0, 3))
+    days.add(easter(year) - datetime.timedelta(days=2))
+    days.add(nth_weekday(year, 5, 0, -1))
+    if year >= 2022:
+        days.add(observed(datetime.date(year, 6, 19)))
+    days.add(observed(datetime.date(year, 7, 4)))
+    days.add(nth_weekday(year, 9, 0, 1))
+    days.add(nth_weekday(year, 11, 3, 4))
+    days.add(observed(datetime.date(year, 12, 25)))
+    return frozenset(days)
+
+
+def is_trading_day(d):
+    """
+    :param d: datetime.date
+    :return: True if the exchanges have a session on d
+    """
+    return d.weekday() < 5 and d not in holidays(d.year) and d not in SPECIAL_CLOSURES
+
+
+def previous_session(d):
+    """
+    :param d: datetime.date
+    :return: d if it is a trading day, otherwise the closest earlier trading day
+    """
+    while not is_trading_day(d):
+        d -= datetime.timedelta(days=1)
+    return d
+
+
+def resolve(eff_date):
+    """
+    Apply calendar_policy to a requested date
+    :param eff_date: ISO format date
+    :return: (ISO format date to look up, None) or (None, error message)
+    """
+    policy = SMFConfiguration.get("calendar_policy")
+    if policy not in POLICIES or policy == "exact":
+        return eff_date, None
+    try:
+        d = datetime.datetime.strptime(eff_date, "%Y-%m-%d").date()
+    except ValueError:
+        # Let the caller report the bad date as before
+        return eff_date, None
+    if is_trading_day(d) or d > datetime.date.today():
+        return eff_date, None
+    if policy == "error":
+        return None, "{0} is not a trading day".format(eff_date)
+    return previous_session(d).strftime("%Y-%m-%d"), None
@@ -0,0 +1,158 @@
+#  wsj_hist.py - Retrieve historical quotes from the Wall Street Journal for the SMF Extension.
+#
+#  license: GNU LGPL
+#
+#  This library is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  NOTE
+#  Promoted from wsj_hist_test.py. The WSJ historical prices page needs
+#  the kind of instrument in addition to the ticker symbol:
+#
+#  stock   historicalprices/4/TICKER     instrumentType=STOCK
+#  etf     historicalpricesetf/4/TICKER  instrumentType=FUND
+#  mutf    historicalpricesfund/4/TICKER instrumentType=FUND
+#
+#  There is no simple way to tell which one a ticker is, so they are tried
+#  in that order and the one that answers is remembered for the ticker.
+#  A type that WSJ refuses with an HTTP error does not stop the others.
+#  The page holds one cr_dataTable row per trading day:
+#
+#  <tr>
+#      <td>05/30/17</td>
+#      <td>39.0700</td>   open
+#      <td>39.0770</td>   high
+#      <td>38.9600</td>   low
+#      <td>38.9900</td>   close
+#  </tr>
+#
+#  The page is parsed as it arrives and reading stops after the data table.
+#
+
+import codecs
+import datetime
+import threading
+from html.parser import HTMLParser
+from urllib.error import HTTPError
+from app_logger import AppLogger
+import http_client
+import html_hist_quote
+
+# Logger init
+app_logger = AppLogger("smf-extension")
+logger = app_logger.getAppLogger()
+
+# (URL type, WSJ instrumentType) in the order they are tried
+INSTRUMENT_TYPES = [("", "STOCK"), ("etf", "FUND"), ("fund", "FUND")]
+# WSJ column order, the header is in a separate table
+COLUMNS = ["date", "open", "high", "low", "close", "volume"]
+
+# ticker -> (URL type, WSJ instrumentType) that returned data
+instrument_lock = threading.Lock()
+instrument_types = {}
+
+
+class WSJHistParser(HTMLParser):
+    """
+    Streaming parser for the WSJ historical prices page. done is set at the
+    end of the data table.
+    """
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.tbody_on = False
+        self.done = False
+        self.td_on = False
+        self.cell_text = []
+        self.row = []
+        self.rows = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "tbody":
+            self.tbody_on = True
+        elif tag == "tr" and self.tbody_on:
+            self.row = []
+        elif tag == "td" and self.tbody_on:
+            self.td_on = True
+            self.cell_text = []
+
+    def handle_endtag(self, tag):
+        if not self.tbody_on:
+            return
+        if tag == "td" and self.td_on:
+            self.row.append("".join(self.cell_text).strip())
+            self.td_on = False
+        elif tag == "tr":
+            if self.row:
+                self.rows.append(dict(zip(COLUMNS, self.row)))
+            self.row = []
+        elif tag == "tbody":
+            self.tbody_on = False
+            self.done = True
+
+    def handle_data(self, data):
+        if self.td_on:
+            self.cell_text.append(data)
+
+
+def download_wsj_quotes(ticker, start_date, end_date):
+    """
+    Download the quotes for a date range from WSJ
+    :param ticker:
+    :param start_date: ISO format start date
+    :param end_date: ISO format end date
+    :return: A list of Quotes, one per trading day. Empty if WSJ has no data.
+    Raises HTTPError if every instrument type was refused, or URLError if the call failed.
+    """
+    with instrument_lock:
+        known = instrument_types.get(ticker)
+    error = None
+    answered = False
+    for instrument in ([known] if known else INSTRUMENT_TYPES):
+        try:
+            quotes = download_page(ticker, instrument, start_date, end_date)
+        except HTTPError as ex:
+            # e.g. 404 when the ticker is not this kind of instrument
+            logger.debug("WSJ %s refused %s: %s", instrument[1], ticker, str(ex))
+            error = ex
+            continue
+        answered = True
+        if quotes:
+            with instrument_lock:
+                instrument_types[ticker] = instrument
+            return quotes
+    if error is not None and not answered:
+        raise error
+    return []
+
+
+def download_page(ticker, instrument, start_date, end_date):
+    """
+    Download one WSJ historical prices page
+    :param instrument: (URL type, WSJ instrumentType)
+    :return: A list of Quotes
+    """
+    url_type, wsj_type = instrument
+    days = (datetime.datetime.strptime(end_date, "%Y-%m-%d") -
+            datetime.datetime.strptime(start_date, "%Y-%m-%d")).days + 1
+    template_url = "http://quotes.wsj.com/ajax/historicalprices{0}/4/{1}?MOD_VIEW=page&ticker={1}" \
+                   "&instrumentType={2}&num_rows={3}&range_days={3}&startDate={4}&endDate={5}"
+    # {0} = WSJ uri type ("", etf, fund)
+    # {1} = ticker
+    # {2} = WSJ instrumentType (STOCK or FUND)
+    # {3} = number of days
+    # {4} = startDate
+    # {5} = endDate
+    url_string = template_url.format(url_type, ticker, wsj_type, days, start_date, end_date)
+    logger.debug("Calling WSJ: %s", url_string)
+    with http_client.get(url_string, provider="wsj") as response:
+        parser = WSJHistParser()
+        decoder = codecs.getincrementaldecoder(response.headers.get_content_charset() or "utf-8")(errors="replace")
+        while not parser.done:
+            chunk = response.read(http_client.CHUNK_SIZE)
+            if not chunk:
+                break
+            parser.feed(decoder.decode(chunk))
+    # Dates look like 05/30/17
+    return html_hist_quote.Quote.from_rows(ticker, parser.rows, "%m/%d/%y")
@@ -12,43 +12,88 @@
 #  Inspired by ystockquote by Corey Goldberg (cgoldberg@gmail.com)
 #
 import csv
-import sys
 import datetime
-try:
-    from urllib.request import Request, urlopen
-    from urllib.error import URLError
-except ImportError:
-    from urllib2 import Request, urlopen, URLError
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from urllib.error import URLError
 from codecs import iterdecode
+import circuit_breaker
+import deadline
+import http_client
+import single_flight
+import smf_cache
+from smf_config import SMFConfiguration
 
-def fetch_data(self, ticker, datacode):
-    """Get Yahoo data and return desired element to user"""
+#Setup list of Yahoo-defined elements to query with.
+query_list = ['y','d','r1','q','p','o','c1','d1','c','t1','p2','m5','m6',
+              'g','m7','h','m8','m3','l','m4','l1','t8','m','k','v','j',
+              'j1','j5','k4','j6','n','k5','w','x','v','a5','b6','k3','a2',
+              'e','e7','e8','e9','s6','b4','j4','p5','p6','r','r5','r6',
+              'r7','s7']
+stat = ''.join(query_list)
+
+def fetch_data(self, ticker, datacode, request=None):
+    """Get Yahoo data and return desired element to user. request is
+    a pending batch request for ticker, if one was already made."""
     #Check for sane user input for datacode.
     if datacode < 1 or datacode > 53 :
         return 'Invalid Datacode'
-    #Setup list of Yahoo-defined elements to query with.
-    query_list = ['y','d','r1','q','p','o','c1','d1','c','t1','p2','m5','m6',
-                  'g','m7','h','m8','m3','l','m4','l1','t8','m','k','v','j',
-                  'j1','j5','k4','j6','n','k5','w','x','v','a5','b6','k3','a2',
-                  'e','e7','e8','e9','s6','b4','j4','p5','p6','r','r5','r6',
-                  'r7','s7']
-    stat = ''.join(query_list)
-    #Check whether flags indicate we already have the data we need.
-    if self.yahoo_flag[0] == '1' or self.yahoo_flag[1] != ticker:
-        self.yahoo_reader = query_yahoo(self, ticker, stat)
+    #Check whether we already have the data we need.
+    yahoo_data = lookup_data(self, ticker)
+    if yahoo_data is None:
+        if request is None:
+            #Calc evaluates cells one at a time, so download the other
+            #tickers the sheet asked for recently along with this one.
+            prefetch(self, ticker)
+            request = batcher.request(ticker, flush=True)
+        try:
+            yahoo_data = request.result()
         #Catch errors.
-        if self.yahoo_flag[0] == '1':
-            return self.yahoo_reader
-        #Set flags upon successful query.
-        else:
-            self.yahoo_flag[0] = '0'
-            self.yahoo_flag[1] = ticker
-            #Store csv in memory.
-            self.yahoo_data = [row for row in self.yahoo_reader]
-            cleanup_yahoo(self)
-    return self.yahoo_data[0][int(datacode)-1]
-
-def cleanup_yahoo(self):
+        except URLError as e:
+            if hasattr(e, 'reason'):
+                return e.reason
+            elif hasattr(e,'code'):
+                return 'Error', e.code
+        self.yahoo_store.put(ticker, yahoo_data)
+    return yahoo_data[0][int(datacode)-1]
+
+def prefetch(self, ticker):
+    """Queue the recently requested tickers that are no longer stored,
+    so the next flush downloads them in the same request as ticker."""
+    missing = [other for other in batcher.recent_tickers()
+               if other != ticker and lookup_data(self, other) is None]
+    for other, request in batcher.prefetch(missing).items():
+        request.add_done_callback(lambda done, other=other: store_result(self, other, done))
+
+def store_result(self, ticker, request):
+    """Store the data of a finished prefetch request"""
+    if request.exception() is None:
+        self.yahoo_store.put(ticker, request.result())
+    else:
+        #Don't let a failing ticker spoil later downloads.
+        batcher.forget(ticker)
+
+def lookup_cached(self, ticker, datacode):
+    """Answer from stored data only. Returns None if a download is needed."""
+    if datacode < 1 or datacode > 53 :
+        return 'Invalid Datacode'
+    yahoo_data = lookup_data(self, ticker)
+    if yahoo_data is None:
+        return None
+    return yahoo_data[0][int(datacode)-1]
+
+def lookup_data(self, ticker):
+    """Return stored data for ticker or None"""
+    yahoo_data = self.yahoo_store.get(ticker)
+    if yahoo_data is None:
+        #Use data saved by an earlier session if it is still fresh.
+        yahoo_data = smf_cache.load_snapshot('yahoo', ticker, 'quotes')
+        if yahoo_data is not None:
+            self.yahoo_store.put(ticker, yahoo_data)
+    return yahoo_data
+
+def cleanup_yahoo(yahoo_data):
     """
     Cleanup as many elements as possible to standardized forms
 
@@ -59,63 +104,195 @@ def cleanup_yahoo(self):
     """
     #Format dividend dates to ISO standard.
     try:
-        self.yahoo_data[0][2] = str((datetime.datetime.strptime
-                                     (self.yahoo_data[0][2],'%m/%d/%Y')).date())
+        yahoo_data[0][2] = str((datetime.datetime.strptime
+                                (yahoo_data[0][2],'%m/%d/%Y')).date())
     except:
         pass
     try:
-        self.yahoo_data[0][3] = str((datetime.datetime.strptime
-                                     (self.yahoo_data[0][3],'%m/%d/%Y')).date())
+        yahoo_data[0][3] = str((datetime.datetime.strptime
+                                (yahoo_data[0][3],'%m/%d/%Y')).date())
     except:
         pass
     #Format last trade date to ISO standard.
     try:
-        self.yahoo_data[0][7] = str((datetime.datetime.strptime
-                                     (self.yahoo_data[0][7],'%m/%d/%Y')).date())
+        yahoo_data[0][7] = str((datetime.datetime.strptime
+                                (yahoo_data[0][7],'%m/%d/%Y')).date())
     except:
         pass
     #Format last trade time to ISO standard.
     try:
-        self.yahoo_data[0][9] = str((datetime.datetime.strptime
-                                     (self.yahoo_data[0][9],'%I:%M%p')).time())
+        yahoo_data[0][9] = str((datetime.datetime.strptime
+                                (yahoo_data[0][9],'%I:%M%p')).time())
     except:
         pass
     #Strip % from chg in pct, moving avg's, and pct chg from 52wk high/low.
     for index_1 in (10, 12, 16, 29, 31):
         try:
-            self.yahoo_data[0][index_1] = (self.yahoo_data[0][index_1]
-                                           ).translate({ord(i):None for i in '%'})
+            yahoo_data[0][index_1] = (yahoo_data[0][index_1]
+                                      ).translate({ord(i):None for i in '%'})
         except:
             pass
     #Convert market cap, rev, EBITDA to floats.
     for index_2 in (26, 43, 45):
         try:
-            big_val = self.yahoo_data[0][index_2]
+            big_val = yahoo_data[0][index_2]
             if 'B' in big_val:
-                self.yahoo_data[0][index_2] = ((float(big_val.translate
-                                                      ({ord(i):None for i in 'B'}
-                                                       )))*1000000000)
+                yahoo_data[0][index_2] = ((float(big_val.translate
+                                                 ({ord(i):None for i in 'B'}
+                                                  )))*1000000000)
             elif 'M' in big_val:
-                self.yahoo_data[0][index_2] = ((float(big_val.translate
-                                                      ({ord(i):None for i in 'M'}
-                                                       )))*1000000)
+                yahoo_data[0][index_2] = ((float(big_val.translate
+                                                 ({ord(i):None for i in 'M'}
+                                                  )))*1000000)
         except:
             pass
     return
  
-def query_yahoo(self, ticker, stat):
-    """Query Yahoo for the data we want""" 
-    url = 'http://download.finance.yahoo.com/d/quotes.csv?s=%s&f=%s' % (ticker, stat)
-    req = Request(url)
+class YahooBatcher:
+    """
+    Collects the tickers requested within a short window and downloads
+    them together. The quotes csv accepts many + joined symbols and
+    returns one row per symbol in the same order.
+    """
+    def __init__(self, window, chunk_size):
+        self.window = window
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        #ticker -> Future, for tickers waiting for the next download
+        self.pending = OrderedDict()
+        #ticker -> Future, for tickers being downloaded
+        self.in_flight = {}
+        self.timer = None
+        #Most recently requested tickers, at most chunk_size of them
+        self.recent = OrderedDict()
+        self.downloads = 0
+        self.tickers = 0
+        self.prefetched = 0
+
+    def request(self, ticker, flush=False):
+        """
+        Request data for ticker. Returns a Future for the cleaned up data.
+        With flush, the pending tickers are downloaded now in the calling
+        thread instead of when the window closes.
+        """
+        with self.lock:
+            self.recent.pop(ticker, None)
+            self.recent[ticker] = None
+            if len(self.recent) > self.chunk_size:
+                self.recent.popitem(last=False)
+            request = self.in_flight.get(ticker) or self.pending.get(ticker)
+            if request is None:
+                request = Future()
+                self.pending[ticker] = request
+            if not flush and self.pending and self.timer is None:
+                self.timer = threading.Timer(self.window, self.__flush_in_background)
+                self.timer.daemon = True
+                self.timer.start()
+        if flush:
+            self.flush()
+        return request
+
+    def recent_tickers(self):
+        """Return the most recently requested tickers, oldest first"""
+        with self.lock:
+            return list(self.recent)
+
+    def prefetch(self, tickers):
+        """Queue tickers for the next flush without starting the window
+        timer. Room is left for one more ticker in the first chunk, newest
+        tickers first. Returns ticker -> Future for the tickers queued."""
+        requests = {}
+        with self.lock:
+            room = self.chunk_size - len(self.pending) - 1
+            for ticker in reversed(tickers):
+                if len(requests) >= room:
+                    break
+                if ticker in self.in_flight or ticker in self.pending:
+                    continue
+                requests[ticker] = self.pending[ticker] = Future()
+            self.prefetched += len(requests)
+        return requests
+
+    def forget(self, ticker):
+        """Stop prefetching ticker until it is requested again"""
+        with self.lock:
+            self.recent.pop(ticker, None)
+
+    def flush(self):
+        """Download every pending ticker in chunks"""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            batch = self.pending
+            self.pending = OrderedDict()
+            self.in_flight.update(batch)
+        tickers = list(batch)
+        for idx in range(0, len(tickers), self.chunk_size):
+            chunk = tickers[idx:idx + self.chunk_size]
+            try:
+                results = download_batch(chunk)
+                self.downloads += 1
+                self.tickers += len(chunk)
+            except Exception as ex:
+                results = {ticker: ex for ticker in chunk}
+            with self.lock:
+                for ticker in chunk:
+                    del self.in_flight[ticker]
+            for ticker in chunk:
+                if isinstance(results[ticker], Exception):
+                    batch[ticker].set_exception(results[ticker])
+                else:
+                    batch[ticker].set_result(results[ticker])
+
+    def __flush_in_background(self):
+        """Timer flush. It serves background fetches, so it is not held to the recalc budget."""
+        with deadline.exempt():
+            self.flush()
+
+    def statistics(self):
+        """Return batching counters"""
+        with self.lock:
+            return {"pending": len(self.pending),
+                    "in_flight": len(self.in_flight),
+                    "downloads": self.downloads,
+                    "tickers": self.tickers,
+                    "prefetched": self.prefetched}
+
+def download_batch(tickers):
+    """Download tickers in one request. Returns ticker -> cleaned data."""
+    rows = query_yahoo('+'.join(tickers), stat)
+    #Skip blank lines so rows line up with the tickers.
+    rows = [row for row in rows if row]
+    if len(rows) != len(tickers):
+        raise URLError('Yahoo returned %d rows for %d symbols' % (len(rows), len(tickers)))
+    results = {}
+    for ticker, row in zip(tickers, rows):
+        #Rows are copied because cleanup_yahoo modifies them and the
+        #downloaded rows may be shared.
+        yahoo_data = [list(row)]
+        cleanup_yahoo(yahoo_data)
+        results[ticker] = yahoo_data
+    #The data is still good if it cannot be saved.
     try:
-        response = urlopen(req)
-    #Catch errors.
-    except URLError as e:
-        self.yahoo_flag[0] = '1'
-        if hasattr(e, 'reason'):
-            return e.reason
-        elif hasattr(e,'code'):
-            return 'Error', e.code
-    if sys.version_info.major == 3:
-        return csv.reader(iterdecode(response,'utf-8'))
-    return csv.reader(response)
\ No newline at end of file
+        smf_cache.save_snapshots('yahoo', 'quotes', results)
+    except Exception:
+        pass
+    return results
+
+def query_yahoo(ticker, stat):
+    """Query Yahoo for the data we want. ticker may be several + joined
+    symbols."""
+    #Concurrent requests for the same tickers share one download.
+    return single_flight.provider_flight.do(('yahoo', ticker, stat),
+                                            circuit_breaker.call, 'yahoo',
+                                            download_yahoo, ticker, stat)
+
+def download_yahoo(ticker, stat):
+    """Download Yahoo csv and return it as a list of rows"""
+    url = 'http://download.finance.yahoo.com/d/quotes.csv?s=%s&f=%s' % (ticker, stat)
+    with http_client.get(url, provider='yahoo') as response:
+        return [row for row in csv.reader(iterdecode(response,'utf-8'))]
+
+batcher = YahooBatcher(float(SMFConfiguration.get("yahoo_batch_window")),
+                       int(SMFConfiguration.get("yahoo_batch_size")))
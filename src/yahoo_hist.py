@@ -11,8 +11,8 @@
 #
 # WARNING WARNING WARNING
 # Yahoo terminated the service that provided historical quotes somewhere
-# around 5/15/2017. This function will only work for historical quotes
-# that have been captured and cached BEFORE Yahoo terminated the service.
+# around 5/15/2017. Quotes that are not in the cache are now fetched
+# from the historical quote providers (see hist_router.py).
 #
 
 # Python 3
@@ -24,6 +24,9 @@ import json
 import sys
 import urllib.error
 import datetime
+import html_hist_quote
+import smf_cache
+import trading_calendar
 
 
 def fetch_data(self, ticker, tgtdate, datacode):
@@ -50,6 +53,11 @@ def fetch_data(self, ticker, tgtdate, datacode):
         # The IDL actually forces this to be a string.
         eff_date = tgtdate
 
+    # Weekends and holidays resolve to a trading session without any I/O
+    eff_date, msg = trading_calendar.resolve(eff_date)
+    if msg is not None:
+        return msg
+
     # Coerce datacode to Xxxxxx...We know that but the user may not get it right
     if datacode.lower() == "adj_close":
         c_datacode = "Adj_Close"
@@ -59,7 +67,7 @@ def fetch_data(self, ticker, tgtdate, datacode):
     # Look for cache hit first...
     # Since historical data should be constant, only one web call is
     # needed for a ticker/date combination.
-    cr = __lookup_symbol_by_date(ticker, eff_date)
+    cr = smf_cache.lookup_symbol_date(ticker, eff_date)
     if cr:
         print ("Cache hit")
         cv = cr[c_datacode]
@@ -69,84 +77,20 @@ def fetch_data(self, ticker, tgtdate, datacode):
             v = str(cv)
         return v
 
-    # Todo Use Google to get historical data
-
-    return "N/A"
-
-import sqlite3
-import os
-
-def __open_yh_cache():
-    """
-    Open a connection to the cache DB. Create the DB if it does not exist.
-    :return: Database connection.
-    """
-    # Determine cache location based on underlying OS
-    file_name = "smf_yh_cache.sqlite3"
-    if os.name == "posix":
-        # Linux or OS X
-        file_path = "{0}/libreoffice/smf/".format(os.environ["HOME"])
-    elif os.name == "nt":
-        # windows
-        file_path = "{0}\\libreoffice\\smf\\".format(os.environ["LOCALAPPDATA"])
-
-    # Make the folder
-    if not os.path.exists(file_path):
-        print ("Create directory")
-        os.makedirs(file_path)
-
-    full_file_path = file_path + file_name
-
-    # If DB does not exist, create it
-    if not os.path.exists(full_file_path):
-        print ("Create database")
-        conn = sqlite3.connect(full_file_path)
-        conn.execute("CREATE TABLE SymbolDate (Symbol text not null, Date text not null, Open real, High real, Low real, Close real, Volume integer, Adj_Close real, PRIMARY KEY(Symbol,Date))")
-    else:
-        conn = sqlite3.connect(full_file_path)
-
-    # We use the row factory to get named row columns. Makes handling row sets easier.
-    conn.row_factory = sqlite3.Row
-    # The default string type is unicode. This changes it to UTF-8.
-    conn.text_factory = str
-
-    # return connection to the cache DB
-    return conn
-
-
-def __lookup_symbol_by_date(symbol, tgtdate):
-    """
-    Look up cached historical data for a given symbol/date pair.
-    :param symbol:
-    :param tgtdate:
-    :return: Returns the cached DB record. If no record is found, returns None.
-    """
-    conn = __open_yh_cache()
-    rset = conn.execute("SELECT * from SymbolDate where Symbol=? and Date=?", [symbol, tgtdate])
-    r = rset.fetchone()
-    conn.close()
-    # r will be None if no record was found
-    return r
-
-
-def __insert_symbol(symbol, tgtdate, open, high, low, close, volume, adj_close):
-    """
-    Insert a new cache record in the cache DB.
-    :param symbol:
-    :param tgtdate:
-    :param open:
-    :param high:
-    :param low:
-    :param close:
-    :param volume:
-    :param adj_close:
-    :return:
-    """
-    conn = __open_yh_cache()
-    print ("Cache data:", symbol, tgtdate, open, high, low, close, volume, adj_close)
-    conn.execute("INSERT INTO SymbolDate values (?,?,?,?,?,?,?,?)", [symbol, tgtdate, open, high, low, close, volume, adj_close])
-    conn.commit()
-    conn.close()
+    # Backfill through the historical quote providers, which cache the quote
+    v = html_hist_quote.fetch_data(self, ticker, eff_date)
+    if not isinstance(v, float):
+        # An error message
+        return v
+    cr = smf_cache.lookup_symbol_date(ticker, eff_date)
+    if not cr:
+        return v if c_datacode == "Close" else "N/A"
+    cv = cr[c_datacode]
+    try:
+        v = float(cv)
+    except:
+        v = str(cv)
+    return v
 
 
 def __get_yahoo_hist():
@@ -193,7 +137,7 @@ def __get_yahoo_hist():
         # quote is a list
         lst = []
         for q in qr:
-            __insert_symbol(q["symbol"], eff_date, q["open"], q["high"], q["low"], q["close"], q["volume"], q["adj_close"])
+            smf_cache.upsert_quotes([[q["symbol"], eff_date, q["open"], q["high"], q["low"], q["close"], q["volume"], q["adj_close"]]])
             try:
                 v = float(q[c_datacode])
             except:
@@ -204,7 +148,7 @@ def __get_yahoo_hist():
         # quote is:, type(j["query"]["results"]["quote"])
         q = qr
         print ("Cache insert")
-        __insert_symbol(ticker, eff_date, q["Open"], q["High"], q["Low"], q["Close"], q["Volume"], q["Adj_Close"])
+        smf_cache.upsert_quotes([[ticker, eff_date, q["Open"], q["High"], q["Low"], q["Close"], q["Volume"], q["Adj_Close"]]])
         try:
             v = float(q[c_datacode])
         except: